@@ -1,15 +1,47 @@
+import contextvars
 import json
 import os
 import datetime
-from openai import OpenAI
-from app.tool.google_calendar import GoogleCalendarClient
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.tool.google_calendar import get_calendar_client
 from app.database.mongodb import db_manager
+from app.scheduler import schedule_notifications
+from app.followup.tasks import add_notification_times
+from app.agent.context import HISTORY_WINDOW, build_context, schedule_summary_fold
+from app.agent.limiter import AdmissionError, openai_admission
+from app.telemetry import span, record_token_usage, record_tool_loop_iterations, slow_turn_profiler
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-calendar = GoogleCalendarClient()
+_openai_client = None
+_openai_lock = threading.Lock()
+
+def get_openai_client():
+    """Cliente da OpenAI criado no primeiro uso (o import do pacote openai é lento)."""
+    global _openai_client
+    if _openai_client is None:
+        with _openai_lock:
+            if _openai_client is None:
+                from openai import OpenAI
+                # Novas tentativas ficam a cargo do openai_admission, que respeita o prazo do turno
+                _openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _openai_client
+
+# Tempo máximo de um turno, contado a partir da chegada da mensagem
+AGENT_TURN_DEADLINE_SECONDS = float(os.getenv("AGENT_TURN_DEADLINE_SECONDS", "60"))
+# Chamadas ao modelo por turno; a última é feita sem ferramentas para forçar uma resposta
+AGENT_MAX_TOOL_ITERATIONS = int(os.getenv("AGENT_MAX_TOOL_ITERATIONS", "8"))
+BUSY_MESSAGE = "Estou recebendo muitas mensagens agora 😅 Pode tentar de novo em alguns instantes?"
+GIVE_UP_MESSAGE = "Desculpe, não consegui concluir seu pedido agora. Pode reformular ou tentar de novo?"
+
+# Chamadas de ferramenta independentes da mesma resposta rodam em paralelo
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+# Ferramentas com efeito colateral: rodam depois das consultas, uma de cada vez
+SIDE_EFFECT_TOOLS = {"book_appointment"}
 
 def get_calendar_tools():
     return [
@@ -47,6 +79,56 @@ def get_calendar_tools():
                 },
             },
         },
+        {
+            "type": "function",
+            "function": {
+                "name": "check_availability_range",
+                "description": "Verifica a disponibilidade de vários dias de uma vez (ex: a semana toda). Prefira esta ferramenta a várias chamadas de 'check_availability'.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "start_date": {
+                            "type": "string",
+                            "description": "A data inicial no formato YYYY-MM-DD",
+                        },
+                        "end_date": {
+                            "type": "string",
+                            "description": "A data final (inclusive) no formato YYYY-MM-DD",
+                        },
+                    },
+                    "required": ["start_date", "end_date"],
+                },
+            },
+        },
+        {
+            "type": "function",
+            "function": {
+                "name": "find_free_slots",
+                "description": "Encontra os próximos horários livres com a duração desejada dentro do horário de atendimento. Use quando o usuário pedir sugestões de horário.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "duration": {
+                            "type": "integer",
+                            "description": "Duração do compromisso em minutos",
+                        },
+                        "from": {
+                            "type": "string",
+                            "description": "Início da busca (YYYY-MM-DD ou ISO 8601)",
+                        },
+                        "to": {
+                            "type": "string",
+                            "description": "Fim da busca, inclusive (YYYY-MM-DD ou ISO 8601)",
+                        },
+                        "limit": {
+                            "type": "integer",
+                            "description": "Quantidade máxima de horários a retornar (padrão: 5)",
+                        },
+                    },
+                    "required": ["duration", "from", "to"],
+                },
+            },
+        },
         {
             "type": "function",
             "function": {
@@ -78,11 +160,33 @@ def get_calendar_tools():
         },
     ]
 
-def process_message(user_id: str, user_message: str):
+def process_message(user_id: str, user_message: str, deadline: float = None):
+    """
+    Executa um turno do agente e retorna o texto da resposta. `deadline`
+    (time.monotonic()) é, por padrão, AGENT_TURN_DEADLINE_SECONDS a partir de agora;
+    se a OpenAI não tiver vaga antes disso o usuário recebe BUSY_MESSAGE na hora.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + AGENT_TURN_DEADLINE_SECONDS
+    # Turnos mais lentos que PROFILE_SLOW_TURN_SECONDS têm a pilha amostrada e salva
+    with span("agent_turn") as turn, slow_turn_profiler.profile(user_id):
+        if time.monotonic() >= deadline:
+            turn.set(busy="deadline")
+            return BUSY_MESSAGE
+        try:
+            return _process_message(user_id, user_message, deadline)
+        except AdmissionError as e:
+            print(f"🚦 Turno de {user_id} recusado: {e}")
+            turn.set(busy=type(e).__name__)
+            return BUSY_MESSAGE
+
+def _process_message(user_id: str, user_message: str, deadline: float):
     current_date = datetime.date.today().isoformat()
     
-    # Busca o histórico do banco
-    history = db_manager.get_history(user_id)
+    # Busca o resumo e o histórico posterior a ele
+    summary_doc = db_manager.get_summary(user_id) or {}
+    summary = summary_doc.get("summary")
+    entries = db_manager.get_history_entries(user_id, limit=HISTORY_WINDOW, since=summary_doc.get("upto"))
     
     system_message = {"role": "system", "content": f"""Você é um assistente de agendamento do Samuel. 
         Hojé é {current_date}. 
@@ -92,25 +196,63 @@ def process_message(user_id: str, user_message: str):
         
         Siga EXATAMENTE estes passos:
         1. Se a solicitação for complexa, use 'think' para planejar.
-        2. Sempre verifique a disponibilidade usando 'check_availability' antes de qualquer outra coisa.
+        2. Sempre verifique a disponibilidade usando 'check_availability' antes de qualquer outra coisa (para vários dias, use 'check_availability_range').
         3. Se o horário solicitado estiver livre, use 'book_appointment' para marcar.
-        4. Se estiver ocupado, sugira outro serviço/horário.
+        4. Se estiver ocupado, use 'find_free_slots' e sugira outros horários.
         
         Responda sempre em Português de forma gentil e curta.
         Importante: Os agendamentos são feitos no fuso horário America/Sao_Paulo (Brasília)."""}
 
-    messages = [system_message] + history + [{"role": "user", "content": user_message}]
+    # Contexto dentro do orçamento de tokens; turnos antigos são incorporados ao resumo
+    messages, overflow, context_tokens = build_context(system_message, summary, entries, user_message)
+    print(f"📏 Contexto de {user_id}: {context_tokens} tokens, {len(messages)} mensagens")
+    schedule_summary_fold(get_openai_client(), user_id, summary, summary_doc.get("upto"), overflow)
 
-    # Salva a mensagem do usuário no histórico
-    db_manager.save_message(user_id, {"role": "user", "content": user_message})
+    # Mensagens do turno ficam em memória e são gravadas de uma vez (um round trip) no final
+    turn_messages = [{"role": "user", "content": user_message}]
+    try:
+        return _run_tool_loop(user_id, messages, turn_messages, deadline)
+    except AdmissionError:
+        # Nada foi respondido: o usuário vai reenviar, então a mensagem não entra no histórico
+        if len(turn_messages) == 1:
+            turn_messages.clear()
+        raise
+    finally:
+        # Se o turno falhou no meio, grava só a parte consistente para não deixar o histórico inválido
+        try:
+            db_manager.save_messages(user_id, _consistent_prefix(turn_messages))
+        except Exception as e:
+            print(f"Erro ao salvar histórico de {user_id}: {e}")
 
+def _consistent_prefix(turn_messages: list):
+    """Maior prefixo em que toda chamada de ferramenta do assistente já tem sua resposta."""
+    consistent = 0
+    pending = set()
+    for i, msg in enumerate(turn_messages, start=1):
+        if msg["role"] == "assistant":
+            pending = {tc["id"] for tc in msg.get("tool_calls", [])}
+        elif msg["role"] == "tool":
+            pending.discard(msg["tool_call_id"])
+        if not pending:
+            consistent = i
+    return turn_messages[:consistent]
+
+def _run_tool_loop(user_id: str, messages: list, turn_messages: list, deadline: float):
+    iterations = 0
     while True:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            tools=get_calendar_tools(),
-            tool_choice="auto",
-        )
+        iterations += 1
+        last_call = iterations >= AGENT_MAX_TOOL_ITERATIONS
+        with span("openai_completion", model="gpt-4o") as completion:
+            response = openai_admission.create(
+                get_openai_client(),
+                deadline,
+                user_id,
+                model="gpt-4o",
+                messages=messages,
+                tools=get_calendar_tools(),
+                tool_choice="none" if last_call else "auto",
+            )
+            record_token_usage(completion, response.usage)
 
         response_message = response.choices[0].message
         
@@ -132,66 +274,113 @@ def process_message(user_id: str, user_message: str):
             ]
 
         tool_calls = response_message.tool_calls
+        turn_messages.append(msg_dict)
 
         if not tool_calls:
-            # Salva a resposta final do assistente no histórico
-            db_manager.save_message(user_id, msg_dict)
+            record_tool_loop_iterations(iterations)
             return response_message.content
+        if last_call:
+            # Mesmo com tool_choice="none" o modelo pediu ferramentas: encerra o turno
+            turn_messages.pop()
+            record_tool_loop_iterations(iterations)
+            return GIVE_UP_MESSAGE
 
         messages.append(response_message)
-        # Salva a mensagem que chamou a ferramenta no histórico
-        db_manager.save_message(user_id, msg_dict)
         
-        for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            function_args = json.loads(tool_call.function.arguments)
-            
-            print(f"--- Agent calling tool: {function_name}")
-            
-            result = ""
-            if function_name == "think":
-                thought = function_args.get("thought")
-                print(f"💭 PENSAMENTO: {thought}")
-                result = "Pensamento registrado. Continue sua análise."
-            elif function_name == "check_availability":
-                result = calendar.check_availability(function_args.get("date"))
-            elif function_name == "book_appointment":
-                result = calendar.create_event(
-                    summary=function_args.get("summary"),
-                    start_time=function_args.get("start_time"),
-                    end_time=function_args.get("end_time"),
-                    description=function_args.get("description", "")
-                )
-                if result:
-                    event_id = result.get('id')
-                    html_link = result.get('htmlLink')
-                    
-                    # Salva o agendamento para notificações futuras
-                    appointment_info = {
-                        "user_id": user_id,
-                        "event_id": event_id,
-                        "summary": function_args.get("summary"),
-                        "start_time": function_args.get("start_time"),
-                        "end_time": function_args.get("end_time"),
-                        "reminder_sent": False,
-                        "follow_up_sent": False,
-                        "created_at": datetime.datetime.utcnow().isoformat()
-                    }
-                    db_manager.save_appointment(appointment_info)
-                    print(f"💾 Agendamento salvo no banco para notificações: {summary} ({start_time})")
-                    
-                    result = f"Agendamento confirmado: {html_link}"
-                else:
-                    result = "Erro ao realizar o agendamento."
-            
-            print(f"--- Tool output: {result}")
-            
+        # Consultas rodam em paralelo; agendamentos vêm depois, um de cada vez, para que dois
+        # book_appointment do mesmo turno não disputem o horário. Os resultados entram na ordem das chamadas
+        reads = [tc for tc in tool_calls if tc.function.name not in SIDE_EFFECT_TOOLS]
+        writes = [tc for tc in tool_calls if tc.function.name in SIDE_EFFECT_TOOLS]
+        outputs = {}
+        if len(reads) == 1:
+            outputs[reads[0].id] = _execute_tool(user_id, reads[0])
+        elif reads:
+            # copy_context: os spans das ferramentas entram no trace do turno
+            futures = [(tc.id, tool_executor.submit(contextvars.copy_context().run, _execute_tool, user_id, tc))
+                       for tc in reads]
+            outputs.update((call_id, future.result()) for call_id, future in futures)
+        for tool_call in writes:
+            outputs[tool_call.id] = _execute_tool(user_id, tool_call)
+        results = [outputs[tc.id] for tc in tool_calls]
+
+        for tool_call, result in zip(tool_calls, results):
             tool_result_msg = {
                 "tool_call_id": tool_call.id,
                 "role": "tool",
-                "name": function_name,
+                "name": tool_call.function.name,
                 "content": str(result),
             }
             messages.append(tool_result_msg)
-            # Salva o resultado da ferramenta no histórico
-            db_manager.save_message(user_id, tool_result_msg)
+            turn_messages.append(tool_result_msg)
+
+def _execute_tool(user_id: str, tool_call):
+    function_name = tool_call.function.name
+    try:
+        with span("tool_call", tool=function_name):
+            return _run_tool(user_id, tool_call)
+    except Exception as e:
+        # Argumentos inválidos ou falha da API: o modelo recebe o erro e pode corrigir a chamada,
+        # sem derrubar o turno nem descartar os resultados das outras ferramentas
+        print(f"❌ Erro na ferramenta {function_name}: {e!r}")
+        return (f"Erro ao executar {function_name}: {e}. Confira os argumentos "
+                "(datas no formato ISO, ex.: 2030-01-07 ou 2030-01-07T10:00:00) e tente novamente.")
+
+def _run_tool(user_id: str, tool_call):
+    function_name = tool_call.function.name
+    function_args = json.loads(tool_call.function.arguments)
+    
+    print(f"--- Agent calling tool: {function_name}")
+    
+    calendar = get_calendar_client()
+    result = ""
+    if function_name == "think":
+        thought = function_args.get("thought")
+        print(f"💭 PENSAMENTO: {thought}")
+        result = "Pensamento registrado. Continue sua análise."
+    elif function_name == "check_availability":
+        result = calendar.check_availability(function_args.get("date"))
+    elif function_name == "check_availability_range":
+        result = calendar.check_availability_range(
+            function_args.get("start_date"),
+            function_args.get("end_date")
+        )
+    elif function_name == "find_free_slots":
+        result = calendar.describe_free_slots(
+            int(function_args.get("duration")),
+            function_args.get("from"),
+            function_args.get("to"),
+            int(function_args.get("limit") or 5)
+        )
+    elif function_name == "book_appointment":
+        result = calendar.create_event(
+            summary=function_args.get("summary"),
+            start_time=function_args.get("start_time"),
+            end_time=function_args.get("end_time"),
+            description=function_args.get("description", "")
+        )
+        if result:
+            event_id = result.get('id')
+            html_link = result.get('htmlLink')
+            
+            # Salva o agendamento para notificações futuras
+            appointment_info = {
+                "user_id": user_id,
+                "event_id": event_id,
+                "summary": function_args.get("summary"),
+                "start_time": function_args.get("start_time"),
+                "end_time": function_args.get("end_time"),
+                "reminder_sent": False,
+                "follow_up_sent": False,
+                "created_at": datetime.datetime.utcnow().isoformat()
+            }
+            add_notification_times(appointment_info)
+            db_manager.save_appointment(appointment_info)
+            schedule_notifications(appointment_info)
+            print(f"💾 Agendamento salvo no banco para notificações: {appointment_info['summary']} ({appointment_info['start_time']})")
+            
+            result = f"Agendamento confirmado: {html_link}"
+        else:
+            result = "Erro ao realizar o agendamento."
+    
+    print(f"--- Tool output: {result}")
+    return result
@@ -0,0 +1,208 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from app.database.mongodb import db_manager
+from app.agent.limiter import openai_admission
+from app.telemetry import span, record_token_usage
+
+load_dotenv()
+
+# Orçamento de tokens do contexto enviado ao modelo (system + resumo + histórico + mensagem)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+# Turnos (mensagem do usuário + respostas) mantidos na íntegra; os mais antigos vão para o resumo
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "6"))
+# Turnos recentes em que as chamadas de ferramenta (exceto 'think') são preservadas
+CONTEXT_TOOL_TURNS = int(os.getenv("CONTEXT_TOOL_TURNS", "2"))
+# Tamanho máximo de uma saída de ferramenta antiga
+TOOL_OUTPUT_MAX_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_CHARS", "300"))
+# Quantas mensagens buscar no banco (depois do ponto já resumido)
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "60"))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+# Prazo da atualização do resumo (passa pelo mesmo controle de admissão dos turnos)
+SUMMARY_DEADLINE_SECONDS = float(os.getenv("SUMMARY_DEADLINE_SECONDS", "120"))
+
+# O resumo é atualizado em segundo plano para não atrasar a resposta ao usuário
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+_folding = set()
+
+
+_encoding = None
+
+
+def load_encoding():
+    """
+    Carrega o vocabulário do tiktoken. Na primeira vez ele é baixado (sem timeout), por
+    isso é chamado na inicialização e nunca dentro de um turno; até lá count_tokens usa a
+    estimativa por caracteres. Com TIKTOKEN_CACHE_DIR o arquivo vem de um cache local.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # Sem tiktoken (ou sem acesso ao arquivo de vocabulário): fica a estimativa
+            print(f"tiktoken indisponível, contando tokens por estimativa: {e}")
+    return _encoding
+
+
+def count_tokens(messages: list):
+    """Conta (ou estima) os tokens de uma lista de mensagens no formato da API da OpenAI."""
+    encoding = _encoding
+    total = 0
+    for msg in messages:
+        text = msg.get("content") or ""
+        if msg.get("tool_calls"):
+            text += json.dumps(msg["tool_calls"], ensure_ascii=False)
+        total += 4  # overhead por mensagem (role, separadores)
+        total += len(encoding.encode(text)) if encoding else len(text) // 4 + 1
+    return total
+
+
+def _split_turns(entries: list):
+    """Agrupa as mensagens em turnos, cada um começando por uma mensagem do usuário."""
+    turns = []
+    for entry in entries:
+        if entry["message"]["role"] == "user":
+            turns.append([entry])
+        elif turns:
+            turns[-1].append(entry)
+        # Respostas de ferramenta órfãs no início (sem a chamada correspondente) são descartadas
+    return turns
+
+
+def _truncate(text: str):
+    if len(text) <= TOOL_OUTPUT_MAX_CHARS:
+        return text
+    return text[:TOOL_OUTPUT_MAX_CHARS] + "…"
+
+
+def _compact_turn(turn: list, keep_tools: bool):
+    """
+    Remove o tráfego de 'think' e encurta saídas de ferramentas. Em turnos antigos
+    (keep_tools=False) sobram apenas as mensagens do usuário e os textos do assistente.
+    """
+    compacted = []
+    dropped_ids = set()
+    for entry in turn:
+        msg = entry["message"]
+        role = msg["role"]
+        if role == "assistant" and msg.get("tool_calls"):
+            calls = [tc for tc in msg["tool_calls"] if keep_tools and tc["function"]["name"] != "think"]
+            dropped_ids.update(tc["id"] for tc in msg["tool_calls"] if tc not in calls)
+            if calls:
+                msg = {"role": "assistant", "content": msg.get("content"), "tool_calls": calls}
+            elif msg.get("content"):
+                msg = {"role": "assistant", "content": msg["content"]}
+            else:
+                continue
+        elif role == "tool":
+            if msg["tool_call_id"] in dropped_ids:
+                continue
+            msg = {**msg, "content": _truncate(msg.get("content") or "")}
+        compacted.append(msg)
+    return compacted
+
+
+def build_context(system_message: dict, summary: str, entries: list, user_message: str,
+                  budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Monta as mensagens da requisição dentro do orçamento de tokens.
+
+    Retorna (messages, overflow, tokens): `overflow` são as entradas do histórico que
+    ficaram de fora e devem ser incorporadas ao resumo.
+    """
+    head = [system_message]
+    if summary:
+        head.append({"role": "system", "content": f"Resumo da conversa anterior com este usuário: {summary}"})
+    user_msg = {"role": "user", "content": user_message}
+    used = count_tokens(head + [user_msg])
+
+    turns = _split_turns(entries)
+    kept = []
+    overflow = []
+    for age, turn in enumerate(reversed(turns)):
+        compacted = _compact_turn(turn, keep_tools=age < CONTEXT_TOOL_TURNS)
+        cost = count_tokens(compacted)
+        if age >= CONTEXT_MAX_TURNS or used + cost > budget:
+            overflow = [entry for older in turns[:len(turns) - age] for entry in older]
+            break
+        kept = compacted + kept
+        used += cost
+
+    return head + kept + [user_msg], overflow, used
+
+
+def _summarise(client, previous_summary: str, entries: list):
+    lines = []
+    for entry in entries:
+        msg = entry["message"]
+        # Só o que foi dito: chamadas e saídas de ferramentas ficam de fora do resumo
+        if msg["role"] == "user" or (msg["role"] == "assistant" and msg.get("content")):
+            speaker = "Usuário" if msg["role"] == "user" else "Assistente"
+            lines.append(f"{speaker}: {msg['content']}")
+    if not lines:
+        return previous_summary
+
+    with span("openai_completion", model=SUMMARY_MODEL) as completion:
+        response = openai_admission.create(
+            client,
+            time.monotonic() + SUMMARY_DEADLINE_SECONDS,
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "Atualize o resumo de uma conversa de agendamento. "
+                                              "Mantenha nomes, datas, horários e compromissos marcados ou pendentes. "
+                                              "Responda apenas com o novo resumo, em no máximo 120 palavras."},
+                {"role": "user", "content": f"Resumo atual: {previous_summary or '(vazio)'}\n\nNovas mensagens:\n" + "\n".join(lines)},
+            ],
+            max_tokens=300,
+        )
+        record_token_usage(completion, response.usage)
+    return response.choices[0].message.content
+
+
+def _next_chunk(user_id: str, since, until):
+    """
+    Próximas mensagens ainda não resumidas (até HISTORY_WINDOW), sem cortar um turno:
+    as mensagens de um turno têm o mesmo ts, e o resumo avança por ts.
+    """
+    chunk = db_manager.get_history_range(user_id, since, until, HISTORY_WINDOW)
+    if len(chunk) == HISTORY_WINDOW:
+        last_ts = chunk[-1]["ts"]
+        whole = [entry for entry in chunk if entry["ts"] != last_ts]
+        if whole:
+            return whole
+    return chunk
+
+
+def _fold_into_summary(client, user_id: str, previous_summary: str, since, until):
+    try:
+        # Tudo entre o resumo atual e `until` entra no resumo, em blocos, inclusive o que
+        # ficou mais antigo que a janela do histórico e nunca apareceu no contexto
+        summary, folded = previous_summary, 0
+        while True:
+            chunk = _next_chunk(user_id, since, until)
+            if not chunk:
+                break
+            summary = _summarise(client, summary, chunk)
+            since = chunk[-1]["ts"]
+            db_manager.save_summary(user_id, summary, since)
+            folded += len(chunk)
+        print(f"🧾 Resumo de {user_id} atualizado ({folded} mensagens incorporadas)")
+    except Exception as e:
+        print(f"Erro ao atualizar resumo de {user_id}: {e}")
+    finally:
+        _folding.discard(user_id)
+
+
+def schedule_summary_fold(client, user_id: str, previous_summary: str, since, overflow: list):
+    """
+    Incorpora ao resumo, em segundo plano, as mensagens posteriores a `since` (o ponto já
+    resumido) até a última de `overflow` (no máximo uma atualização por usuário por vez).
+    """
+    if not overflow or user_id in _folding:
+        return
+    _folding.add(user_id)
+    _summary_executor.submit(_fold_into_summary, client, user_id, previous_summary, since, overflow[-1]["ts"])
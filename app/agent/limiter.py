@@ -0,0 +1,231 @@
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from app.telemetry import registry
+
+load_dotenv()
+
+# Chamadas simultâneas à OpenAI (o limite efetivo cai quando a API responde 429)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+# Chamadas esperando vaga; acima disso a resposta é "ocupado" na hora
+OPENAI_MAX_WAITING = int(os.getenv("OPENAI_MAX_WAITING", "32"))
+# Tempo máximo que uma chamada espera por vaga (ou pelo reset da cota) antes de desistir
+OPENAI_MAX_QUEUE_SECONDS = float(os.getenv("OPENAI_MAX_QUEUE_SECONDS", "10"))
+# Chamadas por minuto permitidas para um mesmo usuário
+OPENAI_USER_RPM = int(os.getenv("OPENAI_USER_RPM", "30"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# Abaixo desta quantidade de tokens restantes na janela, novas chamadas esperam o reset
+OPENAI_TOKEN_RESERVE = int(os.getenv("OPENAI_TOKEN_RESERVE", "4000"))
+
+_admissions = registry.counter("calendar_agent_openai_admissions_total",
+                               "OpenAI calls by admission result (admitted, rejected, throttled, retried)",
+                               ("result",))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_duration(value):
+    """Converte os resets dos headers da OpenAI ('20ms', '1s', '6m0s') em segundos."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def _header_int(headers, name: str):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdmissionError(Exception):
+    """A chamada não foi feita; o agente deve responder com "ocupado, tente de novo"."""
+
+
+class Overloaded(AdmissionError):
+    """Sem capacidade para a chamada (fila cheia, limite do usuário ou OpenAI indisponível)."""
+
+
+class DeadlineExceeded(AdmissionError):
+    """O prazo do turno acabou antes de a chamada ser feita ou concluída."""
+
+
+class OpenAIAdmission:
+    """
+    Controle de admissão das chamadas à OpenAI.
+
+    Limita as chamadas simultâneas (global) e por minuto (por usuário) e
+    acompanha os headers x-ratelimit-* e os 429 da API: quando a cota da
+    janela acaba, novas chamadas esperam o reset e o limite de concorrência é
+    reduzido pela metade, voltando a subir aos poucos. Toda espera respeita o
+    prazo do turno; se não houver vaga a tempo (ou a fila de espera já estiver
+    cheia) a chamada é recusada com Overloaded em vez de ficar na fila.
+    """
+
+    def __init__(self, max_concurrency: int = OPENAI_MAX_CONCURRENCY, max_waiting: int = OPENAI_MAX_WAITING,
+                 max_queue_seconds: float = OPENAI_MAX_QUEUE_SECONDS, user_rpm: int = OPENAI_USER_RPM,
+                 max_retries: int = OPENAI_MAX_RETRIES, token_reserve: int = OPENAI_TOKEN_RESERVE):
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.max_queue_seconds = max_queue_seconds
+        self.user_rpm = user_rpm
+        self.max_retries = max_retries
+        self.token_reserve = token_reserve
+        self.limit = max_concurrency
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._paused_until = 0.0
+        self._successes = 0
+        self._user_buckets = {}  # user_id -> (tokens, monotonic time of the last update)
+
+    def _take_user_token(self, user_id: str):
+        if self.user_rpm <= 0:
+            return
+        now = time.monotonic()
+        with self._cond:
+            tokens, updated = self._user_buckets.get(user_id, (self.user_rpm, now))
+            tokens = min(self.user_rpm, tokens + (now - updated) * self.user_rpm / 60)
+            if tokens < 1:
+                _admissions.inc(result="rejected")
+                raise Overloaded(f"limite de {self.user_rpm} chamadas por minuto atingido para {user_id}")
+            self._user_buckets[user_id] = (tokens - 1, now)
+            if len(self._user_buckets) > 10000:
+                # Baldes cheios são iguais a não ter balde: descarta para a memória não crescer
+                full_since = now - 60
+                self._user_buckets = {user: bucket for user, bucket in self._user_buckets.items()
+                                      if bucket[1] > full_since}
+
+    @contextmanager
+    def slot(self, deadline: float, user_id: str = None):
+        """
+        Ocupa uma das vagas de chamada simultânea; falha em vez de esperar além de
+        `deadline` ou de max_queue_seconds.
+        """
+        if user_id:
+            self._take_user_token(user_id)
+        give_up = min(deadline, time.monotonic() + self.max_queue_seconds)
+        with self._cond:
+            if self._waiting >= self.max_waiting:
+                _admissions.inc(result="rejected")
+                raise Overloaded(f"{self._waiting} chamadas já esperando a OpenAI")
+            self._waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now >= self._paused_until and self._active < self.limit:
+                        break
+                    if now >= deadline:
+                        _admissions.inc(result="rejected")
+                        raise DeadlineExceeded("prazo do turno esgotado esperando a OpenAI")
+                    if self._paused_until > give_up or now >= give_up:
+                        _admissions.inc(result="rejected")
+                        raise Overloaded("sem vaga na OpenAI dentro do tempo de espera")
+                    self._cond.wait(max(self._paused_until - now, 0) or give_up - now)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+            _admissions.inc(result="admitted")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+    def observe(self, headers):
+        """Ajusta a admissão conforme os headers x-ratelimit-* de uma resposta bem-sucedida."""
+        now = time.monotonic()
+        with self._cond:
+            pause_until = self._paused_until
+            remaining_requests = _header_int(headers, "x-ratelimit-remaining-requests")
+            if remaining_requests is not None and remaining_requests <= self._active - 1:
+                # Cada chamada em andamento vai gastar uma requisição da janela
+                reset = _parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0
+                pause_until = max(pause_until, now + reset)
+            remaining_tokens = _header_int(headers, "x-ratelimit-remaining-tokens")
+            if remaining_tokens is not None and remaining_tokens < self.token_reserve:
+                reset = _parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0
+                pause_until = max(pause_until, now + reset)
+            self._paused_until = pause_until
+
+            # Aumento aditivo: +1 no limite a cada `limit` respostas sem 429
+            self._successes += 1
+            if self.limit < self.max_concurrency and self._successes >= self.limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify()
+
+    def throttled(self, retry_after: float):
+        """Reage a um 429: reduz o limite pela metade e pausa novas chamadas por `retry_after` segundos."""
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        _admissions.inc(result="throttled")
+
+    def create(self, client, deadline: float, user_id: str = None, **kwargs):
+        """
+        client.chat.completions.create com controle de admissão: espera uma vaga,
+        usa o tempo restante até `deadline` como timeout da requisição e repete
+        em 429/5xx/erros de conexão enquanto o prazo permitir.
+        """
+        from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+        attempt = 0
+        while True:
+            # O balde por usuário só é consumido na primeira tentativa
+            with self.slot(deadline, user_id if attempt == 0 else None):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("prazo do turno esgotado")
+                try:
+                    raw = client.chat.completions.with_raw_response.create(timeout=remaining, **kwargs)
+                except RateLimitError as e:
+                    retry_after = (_parse_duration(e.response.headers.get("retry-after"))
+                                   or _parse_duration(e.response.headers.get("x-ratelimit-reset-requests"))
+                                   or 1.0)
+                    # A pausa vale para todos: a nova tentativa espera dentro de slot()
+                    self.throttled(retry_after)
+                    error, delay = e, 0.0
+                except APITimeoutError as e:
+                    if time.monotonic() >= deadline:
+                        raise DeadlineExceeded("prazo do turno esgotado esperando a OpenAI") from e
+                    error, delay = e, 0.5 * 2 ** attempt
+                except (APIConnectionError, InternalServerError) as e:
+                    error, delay = e, 0.5 * 2 ** attempt
+                else:
+                    self.observe(raw.headers)
+                    return raw.parse()
+
+            attempt += 1
+            delay += random.uniform(0, 0.25)
+            if attempt > self.max_retries or time.monotonic() + delay >= deadline:
+                raise Overloaded(f"OpenAI indisponível: {error}") from error
+            _admissions.inc(result="retried")
+            time.sleep(delay)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "active": self._active,
+                "waiting": self._waiting,
+                "paused_seconds": round(max(self._paused_until - time.monotonic(), 0.0), 2),
+            }
+
+
+openai_admission = OpenAIAdmission()
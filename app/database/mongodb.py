@@ -1,61 +1,525 @@
+import asyncio
+import datetime
+import functools
+import inspect
 import os
-from pymongo import MongoClient
+import threading
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
+from app.telemetry import mongo_command_timer
 
 load_dotenv()
 
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/calendar_agent")
+# Dias até uma mensagem do histórico expirar (0 = nunca expira)
+HISTORY_TTL_DAYS = int(os.getenv("HISTORY_TTL_DAYS", "0"))
+# Horas que o id de uma mensagem recebida é lembrado para descartar reentregas
+DEDUP_TTL_HOURS = int(os.getenv("DEDUP_TTL_HOURS", "24"))
+# Dias que uma notificação já entregue fica na outbox (para consulta de latência)
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# Horas que uma mensagem já processada pelos workers fica na fila de entrada
+INBOUND_RETENTION_HOURS = int(os.getenv("INBOUND_RETENTION_HOURS", "24"))
+
+# Pool de conexões de cada cliente (o do event loop da API e o do DatabaseManager têm pools separados).
+# O máximo cobre as threads do dispatcher, das ferramentas e da outbox com folga
+# sem abrir uma conexão por requisição; o mínimo mantém conexões prontas para o
+# primeiro webhook depois de um período ocioso.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "32"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "2"))
+MONGO_MAX_IDLE_SECONDS = int(os.getenv("MONGO_MAX_IDLE_SECONDS", "300"))
+# Tempo máximo esperando uma conexão livre ou um servidor disponível: falha rápido
+# (o webhook aceita a mensagem sem dedup) em vez de segurar a requisição por 30s
+MONGO_TIMEOUT_SECONDS = float(os.getenv("MONGO_TIMEOUT_SECONDS", "5"))
+
+
+def _client_options():
+    return {
+        # tz_aware: horários de notificação voltam como datetime com fuso (UTC)
+        "tz_aware": True,
+        # mongo_command_timer: duração de cada comando vai para o /metrics
+        "event_listeners": [mongo_command_timer],
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_SECONDS * 1000,
+        "waitQueueTimeoutMS": int(MONGO_TIMEOUT_SECONDS * 1000),
+        "serverSelectionTimeoutMS": int(MONGO_TIMEOUT_SECONDS * 1000),
+    }
+
+
+class AsyncDatabaseManager:
+    """
+    Acesso ao MongoDB com o AsyncMongoClient do PyMongo: as consultas rodam no event
+    loop, sem ocupar uma thread cada. É a única implementação das operações; o código
+    síncrono (threads do agente, APScheduler, outbox, workers) usa o DatabaseManager,
+    que executa estas mesmas corrotinas. O cliente fica preso ao event loop em que foi
+    usado pela primeira vez, por isso cada loop tem a sua instância.
+    """
 
-class DatabaseManager:
     def __init__(self):
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client.get_database()
-        self.history = self.db.get_collection("conversation_history")
-        self.appointments = self.db.get_collection("appointments")
+        # A conexão só é criada no primeiro uso, para não atrasar o import/startup da aplicação
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _create_client(self):
+        return AsyncMongoClient(MONGO_URI, **_client_options())
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    @property
+    def db(self):
+        return self.client.get_database()
+
+    @property
+    def history(self):
+        # Um documento por mensagem: {user_id, ts, message}
+        return self.db.get_collection("conversation_messages")
+
+    @property
+    def legacy_history(self):
+        # Formato antigo (um documento por usuário com array "messages"), só para migração
+        return self.db.get_collection("conversation_history")
+
+    @property
+    def summaries(self):
+        # Resumo acumulado das mensagens que já saíram da janela de contexto
+        return self.db.get_collection("conversation_summaries")
+
+    @property
+    def appointments(self):
+        return self.db.get_collection("appointments")
+
+    @property
+    def outbox(self):
+        # Notificações prontas para envio: {_id: "<event_id>:<tipo>", user_id, text, due_at, status, ...}
+        return self.db.get_collection("notification_outbox")
+
+    @property
+    def inbound(self):
+        # Fila durável de mensagens recebidas (modo worker): {user_id, text, received_at, status}
+        return self.db.get_collection("inbound_messages")
+
+    @property
+    def inbound_conversations(self):
+        # Um documento por usuário com mensagens na fila: {_id: user_id, ready, seq, lease, ...}
+        return self.db.get_collection("inbound_conversations")
+
+    @property
+    def processed_messages(self):
+        # Ids (data.key.id) das mensagens do webhook já processadas
+        return self.db.get_collection("processed_messages")
 
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
 
-    def get_history(self, user_id: str, limit: int = 10):
-        """Recupera o histórico de mensagens de um usuário."""
-        doc = self.history.find_one({"user_id": user_id})
-        if doc:
-            return doc.get("messages", [])[-limit:]
-        return []
+    async def ensure_indexes(self):
+        """Cria os índices usados pelo histórico e pelas consultas de notificação."""
+        # _id desempata mensagens gravadas no mesmo milissegundo
+        await self.history.create_index([("user_id", ASCENDING), ("ts", DESCENDING), ("_id", DESCENDING)])
+        await self._ensure_history_ttl()
+        await self.summaries.create_index([("user_id", ASCENDING)], unique=True)
+        await self.processed_messages.create_index([("created_at", ASCENDING)], expireAfterSeconds=DEDUP_TTL_HOURS * 3600)
 
-    def save_message(self, user_id: str, message: dict):
+        await self.outbox.create_index([("status", ASCENDING), ("next_attempt_at", ASCENDING)])
+        await self.outbox.create_index([("status", ASCENDING), ("lease.expires_at", ASCENDING)])
+        # TTL só se aplica a documentos com sent_at, ou seja, já entregues
+        await self.outbox.create_index([("sent_at", ASCENDING)], expireAfterSeconds=OUTBOX_RETENTION_DAYS * 86400)
+
+        await self.inbound.create_index([("user_id", ASCENDING), ("status", ASCENDING), ("received_at", ASCENDING)])
+        await self.inbound.create_index([("done_at", ASCENDING)], expireAfterSeconds=INBOUND_RETENTION_HOURS * 3600)
+        await self.inbound_conversations.create_index([("ready", ASCENDING), ("available_at", ASCENDING), ("next_at", ASCENDING)])
+
+        await self.appointments.create_index([("event_id", ASCENDING)])
+        await self.appointments.create_index([("reminder_sent", ASCENDING), ("reminder_at", ASCENDING)])
+        await self.appointments.create_index([("follow_up_sent", ASCENDING), ("follow_up_at", ASCENDING)])
+
+    async def _ensure_history_ttl(self):
+        """Cria, ajusta ou remove o índice TTL do histórico conforme HISTORY_TTL_DAYS."""
+        name = "history_ttl"
+        if HISTORY_TTL_DAYS <= 0:
+            if name in await self.history.index_information():
+                await self.history.drop_index(name)
+            return
+
+        expire_after = HISTORY_TTL_DAYS * 86400
+        try:
+            await self.history.create_index([("ts", ASCENDING)], name=name, expireAfterSeconds=expire_after)
+        except OperationFailure:
+            # O índice já existe com outro prazo: atualiza sem recriar
+            await self.db.command("collMod", self.history.name,
+                                  index={"name": name, "expireAfterSeconds": expire_after})
+
+    async def migrate_legacy_history(self):
+        """Converte o histórico do formato antigo (array por usuário) para um documento por mensagem."""
+        migrated = 0
+        async for doc in self.legacy_history.find({}):
+            messages = doc.get("messages", [])
+            if messages:
+                # Timestamps sintéticos em sequência preservam a ordem original
+                base = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(milliseconds=len(messages))
+                await self.history.insert_many([
+                    {"user_id": doc["user_id"], "ts": base + datetime.timedelta(milliseconds=i), "message": message}
+                    for i, message in enumerate(messages)
+                ])
+            await self.legacy_history.delete_one({"_id": doc["_id"]})
+            migrated += 1
+        return migrated
+
+    async def get_history_entries(self, user_id: str, limit: int = 10, since=None):
+        """
+        Recupera as últimas `limit` entradas ({ts, message}) de um usuário, em ordem cronológica.
+        Com `since`, considera apenas mensagens posteriores a essa data (ex.: já resumidas).
+        """
+        query = {"user_id": user_id}
+        if since is not None:
+            query["ts"] = {"$gt": since}
+        cursor = self.history.find(
+            query,
+            {"_id": 0, "ts": 1, "message": 1}
+        ).sort([("ts", DESCENDING), ("_id", DESCENDING)]).limit(limit)
+        return (await cursor.to_list())[::-1]
+
+    async def get_history_range(self, user_id: str, since, until, limit: int):
+        """Entradas ({ts, message}) com `since` < ts <= `until`, em ordem cronológica (as mais antigas primeiro)."""
+        query = {"user_id": user_id, "ts": {"$lte": until}}
+        if since is not None:
+            query["ts"]["$gt"] = since
+        cursor = self.history.find(
+            query,
+            {"_id": 0, "ts": 1, "message": 1}
+        ).sort([("ts", ASCENDING), ("_id", ASCENDING)]).limit(limit)
+        return await cursor.to_list()
+
+    async def get_history(self, user_id: str, limit: int = 10):
+        """Recupera as últimas `limit` mensagens de um usuário, em ordem cronológica."""
+        return [entry["message"] for entry in await self.get_history_entries(user_id, limit)]
+
+    async def get_summary(self, user_id: str):
+        """Recupera o resumo da conversa ({summary, upto}) ou None."""
+        return await self.summaries.find_one({"user_id": user_id}, {"_id": 0, "summary": 1, "upto": 1})
+
+    async def save_summary(self, user_id: str, summary: str, upto):
+        """Salva o resumo que cobre as mensagens até `upto`; nunca retrocede um resumo mais novo."""
+        try:
+            await self.summaries.update_one(
+                {"user_id": user_id, "$or": [{"upto": {"$lt": upto}}, {"upto": {"$exists": False}}]},
+                {"$set": {"summary": summary, "upto": upto}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Já existe um resumo mais recente para o usuário
+            pass
+
+    async def save_message(self, user_id: str, message: dict):
         """Adiciona uma mensagem ao histórico do usuário."""
-        self.history.update_one(
-            {"user_id": user_id},
-            {"$push": {"messages": message}},
-            upsert=True
+        await self.history.insert_one({
+            "user_id": user_id,
+            "ts": datetime.datetime.now(datetime.timezone.utc),
+            "message": message
+        })
+
+    async def save_messages(self, user_id: str, messages: list):
+        """Grava várias mensagens de uma vez (um único round trip); a ordem é preservada pelo _id."""
+        if not messages:
+            return
+        ts = datetime.datetime.now(datetime.timezone.utc)
+        await self.history.insert_many(
+            [{"user_id": user_id, "ts": ts, "message": message} for message in messages],
+            ordered=True
         )
 
-    def clear_history(self, user_id: str):
+    async def clear_history(self, user_id: str):
         """Limpa o histórico de um usuário."""
-        self.history.delete_one({"user_id": user_id})
+        await self.history.delete_many({"user_id": user_id})
+        await self.summaries.delete_one({"user_id": user_id})
+        await self.legacy_history.delete_one({"user_id": user_id})
 
-    def save_appointment(self, appointment_data: dict):
+    async def save_appointment(self, appointment_data: dict):
         """Salva um agendamento no banco para fins de notificação."""
-        self.appointments.update_one(
+        await self.appointments.update_one(
             {"event_id": appointment_data["event_id"]},
             {"$set": appointment_data},
             upsert=True
         )
 
-    def get_pending_notifications(self):
-        """Busca agendamentos que precisam de lembrete ou follow-up."""
-        return list(self.appointments.find({
+    async def get_pending_notifications(self):
+        """Busca agendamentos que ainda precisam de lembrete ou follow-up."""
+        return await self.appointments.find({
             "$or": [
-                {"reminder_sent": {"$ne": True}},
-                {"follow_up_sent": {"$ne": True}}
+                {"reminder_sent": False},
+                {"follow_up_sent": False}
             ]
-        }))
+        }).to_list()
 
-    def mark_notification_sent(self, event_id: str, notification_type: str):
-        """Marca um lembrete ou follow-up como enviado."""
-        field = "reminder_sent" if notification_type == "reminder" else "follow_up_sent"
-        self.appointments.update_one(
-            {"event_id": event_id},
-            {"$set": {field: True}}
+    def _due_filter(self, notification_type: str, now, reminder_window):
+        """Filtro (coberto pelo índice <tipo>_sent, <tipo>_at) das notificações vencidas em `now`."""
+        if notification_type == "reminder":
+            # Lembretes cujo início já passou (reminder_at < now - reminder_window) não são mais enviados
+            return {"reminder_sent": False, "reminder_at": {"$lte": now, "$gt": now - reminder_window}}
+        return {"follow_up_sent": False, "follow_up_at": {"$lte": now}}
+
+    async def claim_notification(self, notification_type: str, now, reminder_window, owner: str,
+                                 lease_seconds: int, event_id: str = None):
+        """
+        Reserva atomicamente (find_one_and_update) uma notificação vencida para `owner`
+        por `lease_seconds`. Sem `event_id`, reserva a vencida mais antiga.
+        Retorna o agendamento reservado ou None se não houver nada livre.
+        Uma reserva expirada (processo que caiu no meio do envio) pode ser retomada por outro.
+        """
+        lease_field = f"{notification_type}_lease"
+        query = self._due_filter(notification_type, now, reminder_window)
+        query["$or"] = [
+            {lease_field: {"$exists": False}},
+            {f"{lease_field}.expires_at": {"$lte": now}}
+        ]
+        if event_id:
+            query["event_id"] = event_id
+
+        return await self.appointments.find_one_and_update(
+            query,
+            {"$set": {lease_field: {"owner": owner, "expires_at": now + datetime.timedelta(seconds=lease_seconds)}}},
+            projection={"event_id": 1, "user_id": 1, "summary": 1, f"{notification_type}_at": 1},
+            sort=[(f"{notification_type}_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
         )
 
+    async def enqueue_notification(self, event_id: str, notification_type: str, user_id: str, text: str, due_at):
+        """
+        Grava a notificação na outbox. O _id determinístico torna a operação idempotente:
+        se outro processo já a enfileirou, nada muda.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            await self.outbox.insert_one({
+                "_id": f"{event_id}:{notification_type}",
+                "event_id": event_id,
+                "type": notification_type,
+                "user_id": user_id,
+                "text": text,
+                "due_at": due_at,
+                "created_at": now,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now
+            })
+        except DuplicateKeyError:
+            pass
+
+    async def claim_outbox_message(self, owner: str, lease_seconds: int):
+        """
+        Reserva a próxima mensagem da outbox: uma pendente cujo horário de tentativa chegou,
+        ou uma em envio cuja reserva expirou (processo que caiu no meio do envio).
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        claim = {"$set": {"status": "sending", "lease": {"owner": owner, "expires_at": now + datetime.timedelta(seconds=lease_seconds)}},
+                 "$inc": {"attempts": 1}}
+        message = await self.outbox.find_one_and_update(
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            claim,
+            sort=[("next_attempt_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if message is None:
+            message = await self.outbox.find_one_and_update(
+                {"status": "sending", "lease.expires_at": {"$lte": now}},
+                claim,
+                return_document=ReturnDocument.AFTER
+            )
+        return message
+
+    async def complete_outbox_message(self, message_id: str, owner: str, sent_at, latency_seconds: float):
+        """Marca a mensagem como entregue e registra a latência em relação ao horário previsto."""
+        await self.outbox.update_one(
+            {"_id": message_id, "lease.owner": owner},
+            {"$set": {"status": "sent", "sent_at": sent_at, "latency_seconds": latency_seconds},
+             "$unset": {"lease": ""}}
+        )
+
+    async def fail_outbox_message(self, message_id: str, owner: str, error: str, retry_at=None):
+        """Registra a falha; com `retry_at` a mensagem volta para a fila, sem ele é descartada."""
+        update = {"last_error": error}
+        if retry_at:
+            update.update({"status": "pending", "next_attempt_at": retry_at})
+        else:
+            update["status"] = "failed"
+        await self.outbox.update_one(
+            {"_id": message_id, "lease.owner": owner},
+            {"$set": update, "$unset": {"lease": ""}}
+        )
+
+    async def claim_inbound_conversation(self, owner: str, lease_seconds: int):
+        """
+        Reserva a conversa pronta mais antiga que nenhum outro worker esteja processando.
+        Como só um worker tem a conversa de cada usuário, as mensagens dele saem em ordem.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return await self.inbound_conversations.find_one_and_update(
+            {"ready": True, "available_at": {"$lte": now},
+             "$or": [{"lease": {"$exists": False}}, {"lease.expires_at": {"$lte": now}}]},
+            {"$set": {"lease": {"owner": owner, "expires_at": now + datetime.timedelta(seconds=lease_seconds)}},
+             "$inc": {"attempts": 1}},
+            sort=[("next_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def get_pending_inbound(self, user_id: str):
+        """Mensagens ainda não processadas de um usuário, em ordem de chegada."""
+        return await (self.inbound.find({"user_id": user_id, "status": "pending"})
+                      .sort([("received_at", ASCENDING), ("_id", ASCENDING)]).to_list())
+
+    async def ack_inbound(self, conversation: dict, owner: str, message_ids: list, status: str = "done"):
+        """
+        Conclui as mensagens do turno (status done, ou failed quando descartadas) e libera
+        a conversa. Se chegaram mensagens depois da reserva (seq mudou), ela continua pronta.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if message_ids:
+            await self.inbound.update_many({"_id": {"$in": message_ids}}, {"$set": {"status": status, "done_at": now}})
+        result = await self.inbound_conversations.update_one(
+            {"_id": conversation["_id"], "lease.owner": owner, "seq": conversation["seq"]},
+            {"$set": {"ready": False, "attempts": 0}, "$unset": {"lease": "", "next_at": ""}}
+        )
+        if result.matched_count == 0:
+            await self.inbound_conversations.update_one(
+                {"_id": conversation["_id"], "lease.owner": owner},
+                {"$set": {"attempts": 0}, "$unset": {"lease": ""}}
+            )
+
+    async def retry_inbound(self, conversation: dict, owner: str, error: str, retry_at):
+        """Libera a conversa após uma falha; as mensagens continuam pendentes até `retry_at`."""
+        await self.inbound_conversations.update_one(
+            {"_id": conversation["_id"], "lease.owner": owner},
+            {"$set": {"available_at": retry_at, "last_error": error}, "$unset": {"lease": ""}}
+        )
+
+    async def watch_inbound(self):
+        """Change stream das conversas da fila: um item a cada mensagem nova (insert ou seq alterado)."""
+        pipeline = [{"$match": {"$or": [
+            {"operationType": "insert"},
+            {"updateDescription.updatedFields.seq": {"$exists": True}},
+        ]}}]
+        async with await self.inbound_conversations.watch(pipeline) as stream:
+            async for change in stream:
+                yield change
+
+    async def expire_missed_reminders(self, now, reminder_window):
+        """Marca como perdidos os lembretes cuja reunião já começou, tirando-os da faixa do índice."""
+        result = await self.appointments.update_many(
+            {"reminder_sent": False, "reminder_at": {"$lte": now - reminder_window}},
+            {"$set": {"reminder_sent": True, "reminder_missed": True}}
+        )
+        return result.modified_count
+
+    async def get_appointments_without_due_times(self):
+        """Agendamentos antigos, salvos antes dos campos reminder_at/follow_up_at."""
+        return await self.appointments.find({"reminder_at": {"$exists": False}}).to_list()
+
+    async def mark_notification_sent(self, event_id: str, notification_type: str, owner: str = None):
+        """Marca um lembrete ou follow-up como enviado (e libera a reserva de `owner`, se houver)."""
+        lease_field = f"{notification_type}_lease"
+        query = {"event_id": event_id}
+        if owner:
+            query[f"{lease_field}.owner"] = owner
+        await self.appointments.update_one(
+            query,
+            {"$set": {f"{notification_type}_sent": True}, "$unset": {lease_field: ""}}
+        )
+
+    async def claim_message(self, message_id: str):
+        """Registra o id de uma mensagem recebida. Retorna False se ela já foi processada."""
+        try:
+            await self.processed_messages.insert_one({
+                "_id": message_id,
+                "created_at": datetime.datetime.now(datetime.timezone.utc)
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def enqueue_inbound(self, user_id: str, text: str, message_id: str = None):
+        """
+        Grava uma mensagem recebida na fila durável e marca a conversa como pronta.
+        `seq` aumenta a cada mensagem, para o worker saber se algo chegou durante o turno.
+        Retorna False se a mensagem (mesmo `message_id`) já estava na fila.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        doc = {"user_id": user_id, "text": text, "received_at": now, "status": "pending"}
+        if message_id:
+            doc["_id"] = message_id
+        try:
+            await self.inbound.insert_one(doc)
+            inserted = True
+        except DuplicateKeyError:
+            # Reentrega: a mensagem já está na fila, mas garante que a conversa ficou marcada
+            # (a primeira tentativa pode ter caído entre os dois comandos)
+            inserted = False
+        await self.inbound_conversations.update_one(
+            {"_id": user_id},
+            {"$set": {"ready": True}, "$inc": {"seq": 1}, "$min": {"next_at": now},
+             "$setOnInsert": {"available_at": now, "attempts": 0}},
+            upsert=True
+        )
+        return inserted
+
+
+class DatabaseManager:
+    """
+    Interface síncrona do AsyncDatabaseManager, para as threads do agente, o APScheduler,
+    a outbox e os workers. Cada método executa a corrotina de mesmo nome em um event
+    loop próprio, numa thread dedicada, e espera o resultado; o contexto (contextvars)
+    de quem chamou acompanha a corrotina, então os spans de telemetria continuam ligados.
+    """
+
+    def __init__(self):
+        self._async = AsyncDatabaseManager()
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self):
+        # O loop (e a thread) só é criado no primeiro uso, como a conexão
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="mongodb-loop", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    def __getattr__(self, name):
+        operation = getattr(self._async, name)
+        if not inspect.iscoroutinefunction(operation):
+            raise AttributeError(f"{type(self).__name__} has no synchronous {name!r}")
+
+        @functools.wraps(operation)
+        def call(*args, **kwargs):
+            return self._run(operation(*args, **kwargs))
+        # Guardado na instância: as próximas chamadas não passam mais pelo __getattr__
+        setattr(self, name, call)
+        return call
+
+    def watch_inbound(self):
+        """Versão síncrona (gerador) de AsyncDatabaseManager.watch_inbound."""
+        changes = self._async.watch_inbound()
+        try:
+            while True:
+                try:
+                    yield self._run(anext(changes))
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(changes.aclose())
+
+
 db_manager = DatabaseManager()
+async_db_manager = AsyncDatabaseManager()
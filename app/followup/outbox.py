@@ -0,0 +1,138 @@
+import datetime
+import logging
+import os
+import random
+import threading
+from app.database.mongodb import db_manager
+from app.webhook.evolution_api import EvolutionAPIError, EvolutionClient, evolution_client
+
+# Threads que drenam a outbox em paralelo (a taxa total respeita EVOLUTION_RATE_LIMIT)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+# Tempo que uma mensagem fica reservada para um envio antes de outro processo poder assumi-la
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))
+
+# Sem retries no cliente: a outbox já repete com backoff (OUTBOX_MAX_ATTEMPTS) sem prender a
+# thread em sleeps. O limitador é o mesmo das respostas, então a taxa total da instância se mantém.
+outbox_client = EvolutionClient(pool_size=OUTBOX_WORKERS, max_retries=0, limiter=evolution_client.limiter)
+
+logger = logging.getLogger("calendar_agent.outbox")
+
+
+class OutboxSender:
+    """
+    Envia as notificações gravadas na coleção notification_outbox.
+
+    Várias threads (e vários processos) reservam mensagens pendentes de forma
+    atômica, enviam pelo EvolutionClient e registram a latência de entrega
+    (envio - horário previsto). Falhas voltam para a fila com backoff exponencial.
+
+    A entrega é "pelo menos uma vez": se o envio funciona mas a gravação do resultado
+    falha, a mensagem continua reservada e volta a ser assumida quando a reserva expira.
+    Este processo guarda o resultado pendente e, ao reassumir a mensagem, só repete a
+    gravação; outro processo que a assuma antes, porém, a envia de novo.
+    """
+
+    def __init__(self, owner: str, workers: int = OUTBOX_WORKERS):
+        self.owner = owner
+        self.workers = workers
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._retried = 0
+        self._failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        # Resultados já decididos (entregue ou descartada) cuja gravação falhou, por _id
+        self._unrecorded = {}
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def notify(self):
+        """Acorda as threads após enfileirar algo, sem esperar o próximo ciclo de polling."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                message = db_manager.claim_outbox_message(self.owner, OUTBOX_LEASE_SECONDS)
+                if message is None:
+                    self._wake.wait(OUTBOX_POLL_SECONDS)
+                    self._wake.clear()
+                    continue
+                with self._lock:
+                    record = self._unrecorded.pop(message["_id"], None)
+                if record:
+                    # Já enviada ou descartada por esta thread: só falta gravar, nunca reenviar
+                    self._record(message["_id"], record)
+                else:
+                    self._send(message)
+            except Exception:
+                # Uma falha do Mongo não pode matar a thread; a reserva expira e outra tentativa assume
+                logger.exception("Erro ao processar a outbox")
+                self._wake.wait(OUTBOX_POLL_SECONDS)
+
+    def _record(self, message_id: str, record):
+        """Grava o resultado final; se a gravação falhar, guarda para repetir quando a mensagem voltar."""
+        try:
+            record()
+        except Exception:
+            with self._lock:
+                self._unrecorded[message_id] = record
+            raise
+
+    def _send(self, message: dict):
+        message_id = message["_id"]
+        try:
+            outbox_client.send(message["user_id"], message["text"])
+        except Exception as e:
+            attempts, error = message.get("attempts", 1), str(e)
+            # Timeout de leitura ou 5xx: a mensagem pode ter chegado; reenviar poderia duplicá-la
+            maybe_delivered = isinstance(e, EvolutionAPIError) and not e.retryable
+            if attempts >= OUTBOX_MAX_ATTEMPTS or maybe_delivered:
+                print(f"❌ Notificação {message_id} descartada após {attempts} tentativas: {e}")
+                with self._lock:
+                    self._failed += 1
+                self._record(message_id, lambda: db_manager.fail_outbox_message(message_id, self.owner, error, retry_at=None))
+            else:
+                delay = min(2 ** attempts * 5, 600) + random.uniform(0, 5)
+                retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay)
+                with self._lock:
+                    self._retried += 1
+                # Não entregue: se esta gravação falhar, reenviar quando a reserva expirar é o correto
+                db_manager.fail_outbox_message(message_id, self.owner, error, retry_at=retry_at)
+            return
+
+        sent_at = datetime.datetime.now(datetime.timezone.utc)
+        latency = max((sent_at - message["due_at"]).total_seconds(), 0.0)
+        with self._lock:
+            self._sent += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+        self._record(message_id, lambda: db_manager.complete_outbox_message(message_id, self.owner, sent_at, latency))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "sent": self._sent,
+                "retried": self._retried,
+                "failed": self._failed,
+                "delivery_latency_seconds": {
+                    "avg": round(self._latency_total / self._sent, 3) if self._sent else 0.0,
+                    "max": round(self._latency_max, 3),
+                },
+            }
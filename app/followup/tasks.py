@@ -1,66 +1,130 @@
 import datetime
+import os
+import socket
+import uuid
 from app.database.mongodb import db_manager
-from app.webhook.evolution_api import send_whatsapp_message
+from app.followup.outbox import OutboxSender
 from dateutil import parser
 import pytz
 
 # Configuração do fuso horário
 TZ = pytz.timezone("America/Sao_Paulo")
 
-def check_for_notifications():
+# Antecedência do lembrete e atraso do follow-up
+REMINDER_BEFORE = datetime.timedelta(minutes=30)
+FOLLOW_UP_AFTER = datetime.timedelta(minutes=5)
+
+# Várias instâncias (workers/réplicas) dividem os envios reservando cada notificação por um tempo
+NOTIFICATION_LEASE_SECONDS = int(os.getenv("NOTIFICATION_LEASE_SECONDS", "120"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Envio concorrente e com retry das notificações gravadas na outbox
+outbox_sender = OutboxSender(WORKER_ID)
+
+def _deliver(appt: dict, notification_type: str, message: str):
     """
-    Verifica agendamentos pendentes de lembrete (30 min antes) 
-    ou follow-up (5 min depois).
+    Grava a notificação na outbox durável e só então a marca como enviada; a entrega,
+    os retries e a medição de latência ficam com o OutboxSender.
+    Se o processo cair antes de marcar, a reserva expira e o enfileiramento idempotente é refeito.
     """
-    now = datetime.datetime.now(TZ)
-    pending = db_manager.get_pending_notifications()
-    
-    if not pending:
-        # Silencioso se não houver nada pendente para não poluir o log
-        return
+    db_manager.enqueue_notification(
+        appt["event_id"], notification_type, appt["user_id"], message, appt[f"{notification_type}_at"]
+    )
+    db_manager.mark_notification_sent(appt["event_id"], notification_type, WORKER_ID)
+    outbox_sender.notify()
 
-    print(f"⏰ Verificando {len(pending)} agendamentos pendentes em {now.strftime('%H:%M:%S')}")
-    
-    for appt in pending:
+def _to_local(value):
+    """Converte um horário ISO (ou datetime) para datetime com fuso de Brasília."""
+    dt = parser.isoparse(value) if isinstance(value, str) else value
+    # Garantir que os horários tenham fuso horário para comparação
+    if dt.tzinfo is None:
+        return TZ.localize(dt)
+    # Se vier com Z ou outro fuso, converte para o fuso local
+    return dt.astimezone(TZ)
+
+def get_notification_times(appt: dict):
+    """Retorna (início, horário do lembrete, horário do follow-up) de um agendamento."""
+    start_time = _to_local(appt["start_time"])
+    end_time = _to_local(appt["end_time"])
+    # Lembrete: 30 minutos antes do início
+    reminder_time = start_time - REMINDER_BEFORE
+    # Follow-up: 5 minutos depois do término
+    follow_up_time = end_time + FOLLOW_UP_AFTER
+    return start_time, reminder_time, follow_up_time
+
+def add_notification_times(appt: dict):
+    """Grava no agendamento os horários de lembrete e follow-up como datas BSON (consultáveis por índice)."""
+    _, reminder_time, follow_up_time = get_notification_times(appt)
+    appt["reminder_at"] = reminder_time
+    appt["follow_up_at"] = follow_up_time
+    return appt
+
+def backfill_notification_times():
+    """Preenche reminder_at/follow_up_at em agendamentos salvos antes desses campos existirem."""
+    updated = 0
+    for appt in db_manager.get_appointments_without_due_times():
         try:
-            start_time = parser.isoparse(appt["start_time"])
-            end_time = parser.isoparse(appt["end_time"])
-            
-            # Garantir que os horários tenham fuso horário para comparação
-            if start_time.tzinfo is None:
-                start_time = TZ.localize(start_time)
-            elif start_time.tzinfo != TZ:
-                # Se vier com Z ou outro fuso, converte para o fuso local
-                start_time = start_time.astimezone(TZ)
+            appt.setdefault("reminder_sent", False)
+            appt.setdefault("follow_up_sent", False)
+            appt.pop("_id", None)
+            db_manager.save_appointment(add_notification_times(appt))
+            updated += 1
+        except Exception as e:
+            print(f"Erro ao migrar agendamento {appt.get('event_id')}: {e}")
+    return updated
 
-            if end_time.tzinfo is None:
-                end_time = TZ.localize(end_time)
-            elif end_time.tzinfo != TZ:
-                end_time = end_time.astimezone(TZ)
+def send_reminder(appt: dict):
+    summary = appt["summary"]
+    message = f"🔔 *Lembrete:* Sua reunião '{summary}' começa em 30 minutos!"
+    print(f"🚀 Enviando lembrete para {appt['user_id']}: {summary}")
+    _deliver(appt, "reminder", message)
 
-            user_id = appt["user_id"]
-            event_id = appt["event_id"]
-            summary = appt["summary"]
+def send_follow_up(appt: dict):
+    summary = appt["summary"]
+    message = f"👋 Olá! Sua reunião '{summary}' terminou. Como foi? Se precisar de algo, estou aqui."
+    print(f"🚀 Enviando follow-up para {appt['user_id']}: {summary}")
+    _deliver(appt, "follow_up", message)
 
-            # Lembrete: 30 minutos antes do início
-            reminder_time = start_time - datetime.timedelta(minutes=30)
-            
-            # Debug log comentado (pode ativar se necessário)
-            # print(f"Checking '{summary}': Reminder target: {reminder_time.strftime('%H:%M')}, Follow-up target: {(end_time + datetime.timedelta(minutes=5)).strftime('%H:%M')}")
+def _send(notification_type: str, appt: dict):
+    if notification_type == "reminder":
+        send_reminder(appt)
+    else:
+        send_follow_up(appt)
 
-            if not appt.get("reminder_sent") and now >= reminder_time and now < start_time:
-                message = f"🔔 *Lembrete:* Sua reunião '{summary}' começa em 30 minutos!"
-                print(f"🚀 Enviando lembrete para {user_id}: {summary}")
-                send_whatsapp_message(user_id, message)
-                db_manager.mark_notification_sent(event_id, "reminder")
+def run_notification(event_id: str, notification_type: str):
+    """
+    Executada pelo timer de um agendamento no horário exato do lembrete ou follow-up.
+    Só envia se conseguir reservar a notificação: com vários processos, apenas um deles envia.
+    """
+    try:
+        now = datetime.datetime.now(TZ)
+        appt = db_manager.claim_notification(
+            notification_type, now, REMINDER_BEFORE, WORKER_ID, NOTIFICATION_LEASE_SECONDS, event_id=event_id
+        )
+        if appt:
+            _send(notification_type, appt)
+    except Exception as e:
+        print(f"Erro ao processar notificação para evento {event_id}: {e}")
 
-            # Follow-up: 5 minutos depois do término
-            follow_up_time = end_time + datetime.timedelta(minutes=5)
-            if not appt.get("follow_up_sent") and now >= follow_up_time:
-                message = f"👋 Olá! Sua reunião '{summary}' terminou. Como foi? Se precisar de algo, estou aqui."
-                print(f"🚀 Enviando follow-up para {user_id}: {summary}")
-                send_whatsapp_message(user_id, message)
-                db_manager.mark_notification_sent(event_id, "follow_up")
-                
-        except Exception as e:
-            print(f"Erro ao processar notificação para evento {appt.get('event_id')}: {e}")
+def check_for_notifications():
+    """
+    Varredura de segurança: envia lembretes (30 min antes) e follow-ups (5 min depois)
+    já vencidos que não tenham sido atendidos pelos timers, inclusive reservas expiradas
+    de processos que caíram no meio do envio.
+    O custo depende só do que está vencido agora, não do total de agendamentos.
+    """
+    now = datetime.datetime.now(TZ)
+    db_manager.expire_missed_reminders(now, REMINDER_BEFORE)
+
+    for notification_type in ("reminder", "follow_up"):
+        while True:
+            try:
+                appt = db_manager.claim_notification(
+                    notification_type, now, REMINDER_BEFORE, WORKER_ID, NOTIFICATION_LEASE_SECONDS
+                )
+                if not appt:
+                    break
+                _send(notification_type, appt)
+            except Exception as e:
+                print(f"Erro ao processar notificações ({notification_type}): {e}")
+                break
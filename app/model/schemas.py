@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Union
 
 class WebhookKey(BaseModel):
     remoteJid: str
@@ -10,13 +10,20 @@ class WebhookMessage(BaseModel):
     conversation: Optional[str] = None
     extendedTextMessage: Optional[Dict[str, Any]] = None
 
+    @property
+    def text(self) -> Optional[str]:
+        # Plain text arrives in conversation; replies and links in extendedTextMessage.text
+        return self.conversation or (self.extendedTextMessage or {}).get("text")
+
 class WebhookData(BaseModel):
     key: WebhookKey
-    message: Optional[Dict[str, Any]] = None
+    message: Optional[WebhookMessage] = None
     pushName: Optional[str] = None
-    messageTimestamp: Optional[int] = None
+    # Seconds as a number or string, or a protobuf Long ({"low", "high", "unsigned"}) depending on the Evolution version
+    messageTimestamp: Optional[Union[int, str, Dict[str, Any]]] = None
 
 class EvolutionWebhook(BaseModel):
+    # Only messages.upsert payloads are validated; other events are dropped before parsing
     event: str
-    instance: str
-    data: Dict[str, Any]
+    instance: Optional[str] = None
+    data: WebhookData
@@ -1 +1 @@
-from .manager import start_scheduler
+from .manager import start_scheduler, schedule_notifications, start_notification_timers, stop_notification_timers
@@ -1,9 +1,70 @@
+import datetime
+import os
 from apscheduler.schedulers.background import BackgroundScheduler
-from app.followup.tasks import check_for_notifications
+from app.database.mongodb import db_manager
+from app.followup.tasks import (
+    TZ, backfill_notification_times, check_for_notifications, get_notification_times, outbox_sender, run_notification
+)
+
+# Intervalo da varredura de segurança; os envios normais saem pelos timers de cada agendamento
+NOTIFICATION_SWEEP_MINUTES = int(os.getenv("NOTIFICATION_SWEEP_MINUTES", "15"))
+
+# misfire_grace_time=None: um timer atrasado (ex.: servidor ocupado) ainda é executado
+scheduler = BackgroundScheduler(
+    timezone=TZ,
+    job_defaults={"coalesce": True, "misfire_grace_time": None},
+)
+
+def schedule_notifications(appointment: dict):
+    """Cria um timer para o lembrete e outro para o follow-up de um agendamento."""
+    now = datetime.datetime.now(TZ)
+    event_id = appointment["event_id"]
+    start_time, reminder_time, follow_up_time = get_notification_times(appointment)
+
+    if not appointment.get("reminder_sent") and start_time > now:
+        scheduler.add_job(
+            run_notification, 'date', run_date=max(reminder_time, now),
+            args=[event_id, "reminder"], id=f"reminder:{event_id}", replace_existing=True,
+        )
+    if not appointment.get("follow_up_sent"):
+        scheduler.add_job(
+            run_notification, 'date', run_date=max(follow_up_time, now),
+            args=[event_id, "follow_up"], id=f"follow_up:{event_id}", replace_existing=True,
+        )
+
+def restore_notification_timers():
+    """Recria os timers a partir do MongoDB (necessário após reinício do processo)."""
+    restored = 0
+    for appt in db_manager.get_pending_notifications():
+        try:
+            schedule_notifications(appt)
+            restored += 1
+        except Exception as e:
+            print(f"Erro ao restaurar timers do evento {appt.get('event_id')}: {e}")
+    return restored
+
+def start_notification_timers():
+    """
+    Liga só os timers de lembrete/follow-up, com os agendamentos pendentes restaurados.
+    Os processos worker usam isto: eles criam agendamentos (book_appointment) e os timers
+    precisam rodar no processo que os cria para disparar no horário exato. Vários
+    processos com o mesmo timer não duplicam o envio (run_notification reserva antes).
+    """
+    if not scheduler.running:
+        scheduler.start()
+    # Repetir é seguro (replace_existing): start_scheduler é chamado de novo se falhar no meio
+    return restore_notification_timers()
+
+def stop_notification_timers():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
 
 def start_scheduler():
-    scheduler = BackgroundScheduler()
-    # Executa a cada minuto
-    scheduler.add_job(check_for_notifications, 'interval', minutes=1)
-    scheduler.start()
-    print("⏰ Scheduler iniciado (verificação a cada minuto)")
+    migrated = backfill_notification_times()
+    if migrated:
+        print(f"🗂️ {migrated} agendamentos antigos receberam reminder_at/follow_up_at")
+    outbox_sender.start()
+    restored = start_notification_timers()
+    scheduler.add_job(check_for_notifications, 'interval', minutes=NOTIFICATION_SWEEP_MINUTES,
+                      id="notification_sweep", replace_existing=True)
+    print(f"⏰ Scheduler iniciado ({restored} agendamentos com timers, varredura a cada {NOTIFICATION_SWEEP_MINUTES} min)")
@@ -0,0 +1,3 @@
+from .metrics import registry
+from .spans import span, timed, observe_span, record_token_usage, record_tool_loop_iterations, mongo_command_timer
+from .profiler import slow_turn_profiler
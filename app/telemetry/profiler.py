@@ -0,0 +1,106 @@
+import datetime
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Turns slower than this are profiled and saved (0 = profiler off)
+PROFILE_SLOW_TURN_SECONDS = float(os.getenv("PROFILE_SLOW_TURN_SECONDS", "0"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "10"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+def _collapse(frame):
+    """Stack of `frame` in the collapsed format used by flamegraph tools (root first, ';'-separated)."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Opt-in sampling profiler for agent turns.
+
+    While a profiled block runs, one background thread samples its stack every
+    `interval` seconds. If the block takes at least `threshold` seconds, the
+    samples are written to `output_dir` as a .folded file, which
+    flamegraph.pl and speedscope can render. Fast turns are discarded. Nothing
+    is sampled while the threshold is 0.
+    """
+
+    def __init__(self, threshold: float = PROFILE_SLOW_TURN_SECONDS,
+                 interval: float = PROFILE_SAMPLE_INTERVAL_MS / 1000, output_dir: str = PROFILE_DIR):
+        self.threshold = threshold
+        self.interval = interval
+        self.output_dir = output_dir
+        self._active = {}  # thread ident -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    @contextmanager
+    def profile(self, label: str):
+        if not self.enabled:
+            yield
+            return
+
+        ident = threading.get_ident()
+        samples = Counter()
+        with self._lock:
+            self._active[ident] = samples
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._wake.set()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                self._active.pop(ident, None)
+            if duration >= self.threshold:
+                self._dump(label, duration, samples)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if not self._active:
+                    # Cleared under the lock, so a block registering now always wakes us again
+                    self._wake.clear()
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+            time.sleep(self.interval)
+
+    def _dump(self, label: str, duration: float, samples: Counter):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            path = os.path.join(self.output_dir, f"turn-{stamp}-{re.sub(r'[^0-9A-Za-z]+', '_', label)}.folded")
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            print(f"🐢 Turno lento ({label}): {duration:.2f}s, {sum(samples.values())} amostras em {path}")
+        except OSError as e:
+            print(f"Erro ao salvar o perfil do turno lento: {e}")
+
+
+slow_turn_profiler = SamplingProfiler()
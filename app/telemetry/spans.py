@@ -0,0 +1,156 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pymongo import monitoring
+from dotenv import load_dotenv
+from app.telemetry.metrics import registry
+
+load_dotenv()
+
+# Print every finished span as a JSON line (trace id, parent, duration, labels)
+TELEMETRY_LOG_SPANS = os.getenv("TELEMETRY_LOG_SPANS", "false").lower() == "true"
+METRIC_PREFIX = "calendar_agent"
+
+# (trace_id, span_id) of the span running in the current thread/task
+_current = contextvars.ContextVar("telemetry_span", default=None)
+
+_tokens = registry.counter(f"{METRIC_PREFIX}_openai_tokens_total",
+                           "OpenAI tokens used, by model and type (prompt/completion)", ("model", "type"))
+_tool_loop = registry.histogram(f"{METRIC_PREFIX}_tool_loop_iterations",
+                                "Model calls needed to answer one agent turn",
+                                buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+
+
+class Span:
+    """A finished or running timing span; `set` adds attributes that are logged but not used as labels."""
+
+    def __init__(self, name: str, labels: dict, trace_id: str, parent_id: str):
+        self.name = name
+        self.labels = labels
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent_id
+        self.attributes = {}
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+
+def observe_span(name: str, duration: float, **labels):
+    """Records a duration in the `calendar_agent_<name>_duration_seconds` histogram."""
+    histogram = registry.histogram(f"{METRIC_PREFIX}_{name}_duration_seconds",
+                                   f"Duration of {name.replace('_', ' ')} spans in seconds",
+                                   tuple(sorted(labels)))
+    histogram.observe(duration, **labels)
+
+
+def _log(span: Span, outcome: str):
+    record = {"span": span.name, "trace_id": span.trace_id, "span_id": span.span_id,
+              "parent_id": span.parent_id, "duration_ms": round(span.duration * 1000, 2),
+              "outcome": outcome, **span.labels, **span.attributes}
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name: str, **labels):
+    """
+    Times the enclosed block as a span called `name`. Spans opened inside it
+    (same thread or asyncio task) share its trace id. The duration goes to a
+    histogram labelled with `labels` plus outcome=ok/error.
+    """
+    parent = _current.get()
+    current = Span(name, labels, parent[0] if parent else uuid.uuid4().hex[:16], parent[1] if parent else None)
+    token = _current.set((current.trace_id, current.span_id))
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield current
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _current.reset(token)
+        current.duration = time.perf_counter() - start
+        observe_span(name, current.duration, outcome=outcome, **labels)
+        if TELEMETRY_LOG_SPANS:
+            _log(current, outcome)
+
+
+def timed(name: str, **labels):
+    """Decorator form of `span` for plain and async functions."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_token_usage(current: Span, usage):
+    """Counts the tokens of a chat completion and attaches them to its span."""
+    if usage is None:
+        return
+    model = current.labels.get("model", "unknown")
+    _tokens.inc(usage.prompt_tokens, model=model, type="prompt")
+    _tokens.inc(usage.completion_tokens, model=model, type="completion")
+    current.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+def record_tool_loop_iterations(iterations: int):
+    _tool_loop.observe(iterations)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """
+    PyMongo command listener that times every database command, so all
+    DatabaseManager operations are covered without wrapping each method.
+    PyMongo publishes the events inside the task that ran the command, and that
+    task carries the caller's context, so they join the caller's trace.
+    """
+
+    def __init__(self):
+        self._collections = {}  # request_id -> collection name, between started and succeeded/failed
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get("collection", "")
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+    def _finish(self, event, outcome: str):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), "")
+        duration = event.duration_micros / 1_000_000
+        labels = {"command": event.command_name, "collection": collection}
+        observe_span("mongo_command", duration, outcome=outcome, **labels)
+        if TELEMETRY_LOG_SPANS:
+            parent = _current.get()
+            current = Span("mongo_command", labels, parent[0] if parent else None, parent[1] if parent else None)
+            current.duration = duration
+            _log(current, outcome)
+
+
+mongo_command_timer = MongoCommandTimer()
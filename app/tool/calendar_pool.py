@@ -0,0 +1,82 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+# Calendar API services kept for concurrent workers (tool threads, scheduler, outbox)
+CALENDAR_POOL_SIZE = int(os.getenv("CALENDAR_POOL_SIZE", "8"))
+
+
+class CalendarServicePool:
+    """
+    Thread-safe pool of authorised Calendar API service objects.
+
+    A googleapiclient service (and the httplib2 transport under it) must not be
+    used by two threads at once, so each call checks one out for its duration.
+    Up to `size` services are built on demand, each with its own transport, so
+    up to `size` requests run in parallel. Every service shares the same
+    credentials. When they expire, one worker refreshes them under a lock while
+    the others wait, instead of each racing its own refresh.
+    """
+
+    def __init__(self, build_service, credentials=None, size: int = CALENDAR_POOL_SIZE, on_refresh=None):
+        self._build_service = build_service
+        self.credentials = credentials
+        self.size = size
+        self._on_refresh = on_refresh
+        self._idle = queue.LifoQueue()  # most recently used first: its connection is most likely still open
+        self._slots = threading.BoundedSemaphore(size)
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._refreshes = 0
+
+    def _ensure_credentials(self):
+        creds = self.credentials
+        if creds is None or creds.valid:
+            return
+        with self._refresh_lock:
+            # Another worker may have refreshed while this one waited for the lock
+            if creds.valid:
+                return
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+            with self._stats_lock:
+                self._refreshes += 1
+            if self._on_refresh:
+                self._on_refresh(creds)
+
+    @contextmanager
+    def service(self):
+        """Checks out a service for the calling thread; blocks while all `size` are busy."""
+        self._ensure_credentials()
+        with self._slots:
+            try:
+                service = self._idle.get_nowait()
+            except queue.Empty:
+                service = self._build_service()
+                with self._stats_lock:
+                    self._created += 1
+            with self._stats_lock:
+                self._in_use += 1
+            try:
+                yield service
+            finally:
+                with self._stats_lock:
+                    self._in_use -= 1
+                self._idle.put(service)
+
+    def execute(self, make_request):
+        """Runs `make_request(service).execute()` on a pooled service."""
+        with self.service() as service:
+            return make_request(service).execute()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "in_use": self._in_use,
+                "credential_refreshes": self._refreshes,
+            }
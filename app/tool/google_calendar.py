@@ -1,22 +1,126 @@
-import os.path
+import os
+import bisect
 import datetime
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import threading
+import time
+import pytz
+from dateutil import parser
 from googleapiclient.errors import HttpError
+from app.tool.calendar_pool import CalendarServicePool
+from app.tool.slots import find_free_slots
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
-class GoogleCalendarClient:
+# Longest range accepted by check_availability_range
+MAX_RANGE_DAYS = 31
+
+# Working hours and slot rules used by find_free_slots
+WORK_START = datetime.time.fromisoformat(os.getenv("WORK_START", "08:00"))
+WORK_END = datetime.time.fromisoformat(os.getenv("WORK_END", "18:00"))
+WORK_DAYS = tuple(int(day) for day in os.getenv("WORK_DAYS", "0,1,2,3,4,5,6").split(","))  # Monday = 0
+SLOT_BUFFER_MINUTES = int(os.getenv("SLOT_BUFFER_MINUTES", "0"))
+SLOT_STEP_MINUTES = int(os.getenv("SLOT_STEP_MINUTES", "30"))
+# Calendars whose busy times count for check_availability_range. Fixed by configuration,
+# never chosen by the model: any WhatsApp contact could otherwise read other calendars
+AVAILABILITY_CALENDARS = [c.strip() for c in os.getenv("AVAILABILITY_CALENDARS", "primary").split(",") if c.strip()]
+
+# Seconds a synced event store is trusted before the next incremental sync
+CALENDAR_CACHE_TTL = float(os.getenv("CALENDAR_CACHE_TTL", "60"))
+
+TZ = pytz.timezone("America/Sao_Paulo")
+
+
+def _parse_datetime(value: str):
+    """Parses an ISO string into an aware datetime (naive values are taken as Brasília time)."""
+    parsed = parser.isoparse(value)
+    if parsed.tzinfo is None:
+        parsed = TZ.localize(parsed)
+    return parsed
+
+
+def _parse_event_time(value: dict):
+    """Converts an event 'start'/'end' field (dateTime or all-day date) into an aware datetime."""
+    return _parse_datetime(value.get('dateTime', value.get('date')))
+
+
+class EventStore:
+    """In-memory copy of the calendar, kept current through incremental sync (syncToken)."""
+
     def __init__(self):
+        self.events = {}  # event id -> (start, end, event)
+        self.sync_token = None
+        self.last_sync = 0.0
+        # Events sorted by start, rebuilt lazily after changes, so range lookups are a bisect
+        self._index = None
+        self._starts = None
+        self._max_span = datetime.timedelta(0)
+
+    def _ensure_index(self):
+        if self._index is None:
+            self._index = sorted((start, end, event_id) for event_id, (start, end, _) in self.events.items())
+            self._starts = [start for start, _, _ in self._index]
+            self._max_span = max((end - start for start, end, _ in self._index), default=datetime.timedelta(0))
+
+    def _overlapping(self, time_min: datetime.datetime, time_max: datetime.datetime):
+        self._ensure_index()
+        # An event starting before time_min can only overlap it if it is at most _max_span long
+        lo = bisect.bisect_left(self._starts, time_min - self._max_span)
+        hi = bisect.bisect_left(self._starts, time_max)
+        return [item for item in self._index[lo:hi] if item[1] > time_min]
+
+    def apply(self, event: dict):
+        """Inserts, updates or removes (status 'cancelled') a single event."""
+        self._index = None
+        if event.get('status') == 'cancelled':
+            self.events.pop(event['id'], None)
+            return
+        try:
+            start = _parse_event_time(event['start'])
+            end = _parse_event_time(event['end'])
+        except (KeyError, TypeError, ValueError):
+            return
+        self.events[event['id']] = (start, end, event)
+
+    def query(self, time_min: datetime.datetime, time_max: datetime.datetime):
+        """Events overlapping [time_min, time_max), ordered by start time."""
+        return [self.events[event_id][2] for _, _, event_id in self._overlapping(time_min, time_max)]
+
+    def busy_intervals(self, time_min: datetime.datetime, time_max: datetime.datetime):
+        """(start, end) of the events that block time in the range ('transparent' events are free)."""
+        return [
+            (start, end) for start, end, event_id in self._overlapping(time_min, time_max)
+            if self.events[event_id][2].get('transparency') != 'transparent'
+        ]
+
+    def reset(self):
+        self._index = None
+        self.events.clear()
+        self.sync_token = None
+        self.last_sync = 0.0
+
+
+class GoogleCalendarClient:
+    def __init__(self, cache_ttl: float = CALENDAR_CACHE_TTL):
         self.creds = None
-        self.service = None
+        self.pool = None
+        self.cache_ttl = cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._store = EventStore()
+        # Guards the event store and its sync token; API calls go through the service pool
+        self._lock = threading.RLock()
+        # Serialises syncs, so concurrent refreshes don't all fetch the same changes
+        self._sync_lock = threading.Lock()
         self._authenticate()
 
     def _authenticate(self):
-        """Authenticates the user and returns the service object."""
+        """Authenticates the user and sets up the pool of Calendar services."""
+        # Imported here so that importing this module stays cheap; the client is built on first use
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         # Note: We assume token.json and credentials.json are in the root directory relative to execution
         token_path = 'token.json'
         creds_path = 'credentials.json'
@@ -34,32 +138,112 @@ class GoogleCalendarClient:
                 flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
                 self.creds = flow.run_local_server(port=0)
             
-            with open(token_path, 'w') as token:
-                token.write(self.creds.to_json())
+            self._save_token(self.creds)
 
-        try:
-            self.service = build('calendar', 'v3', credentials=self.creds)
-        except HttpError as error:
-            print(f'An error occurred: {error}')
+        self.pool = CalendarServicePool(self._build_service, self.creds, on_refresh=self._save_token)
 
-    def list_events(self, time_min: str, time_max: str):
-        """Lists events between time_min and time_max."""
-        try:
-            events_result = self.service.events().list(
-                calendarId='primary',
-                timeMin=time_min,
-                timeMax=time_max,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-            return events_result.get('items', [])
-        except HttpError as error:
-            print(f'An error occurred: {error}')
-            return []
+    def _build_service(self):
+        from googleapiclient.discovery import build
+        # Discovery document bundled with google-api-python-client: no network fetch, no file cache.
+        # Each service gets its own transport; the credentials object is shared.
+        return build('calendar', 'v3', credentials=self.creds, static_discovery=True, cache_discovery=False)
 
-    def create_event(self, summary: str, start_time: str, end_time: str, description: str = ""):
-        """Creates an event on the calendar."""
-        event = {
+    @staticmethod
+    def _save_token(creds):
+        with open('token.json', 'w') as token:
+            token.write(creds.to_json())
+
+    def _fetch_changes(self, sync_token):
+        """
+        Pulls every change since `sync_token` (or everything, when None). Network only:
+        returns (events, next_sync_token) without touching the event store.
+        """
+        events = []
+        page_token = None
+        while True:
+            params = {'calendarId': 'primary', 'singleEvents': True}
+            if page_token:
+                params['pageToken'] = page_token
+            if sync_token:
+                params['syncToken'] = sync_token
+            events_result = self.pool.execute(lambda service: service.events().list(**params))
+            events.extend(events_result.get('items', []))
+
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return events, events_result.get('nextSyncToken')
+
+    def _is_fresh(self):
+        return self._store.sync_token and time.monotonic() - self._store.last_sync < self.cache_ttl
+
+    def refresh(self, force: bool = False):
+        """
+        Brings the local event store up to date. Incremental sync only runs when
+        the store is older than cache_ttl, unless force=True.
+        Returns False if the calendar could not be reached.
+        """
+        with self._lock:
+            if self._is_fresh() and not force:
+                self.cache_hits += 1
+                return True
+
+        # One sync at a time, and the HTTP calls run outside self._lock: readers of a
+        # store that is still fresh and write-through of new events never wait on them
+        with self._sync_lock:
+            with self._lock:
+                # Another thread may have synced while this one waited
+                if self._is_fresh() and not force:
+                    self.cache_hits += 1
+                    return True
+                self.cache_misses += 1
+                sync_token = self._store.sync_token
+
+            full = sync_token is None
+            try:
+                events, next_token = self._fetch_changes(sync_token)
+            except HttpError as error:
+                if error.resp.status != 410:
+                    print(f'An error occurred: {error}')
+                    return False
+                # 410 Gone: the sync token expired, start over with a full sync
+                full = True
+                try:
+                    events, next_token = self._fetch_changes(None)
+                except HttpError as error:
+                    print(f'An error occurred: {error}')
+                    return False
+
+            with self._lock:
+                if full:
+                    self._store.reset()
+                for event in events:
+                    self._store.apply(event)
+                self._store.sync_token = next_token
+                self._store.last_sync = time.monotonic()
+            return True
+
+    def cache_stats(self):
+        with self._lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "events": len(self._store.events),
+                "age_seconds": round(time.monotonic() - self._store.last_sync, 1) if self._store.sync_token else None,
+                "pool": self.pool.stats(),
+            }
+
+    def list_events(self, time_min: str, time_max: str, force_refresh: bool = False):
+        """Lists events between time_min and time_max, served from the local event store."""
+        refreshed = self.refresh(force=force_refresh)
+        with self._lock:
+            if not refreshed and not self._store.sync_token:
+                return []
+            # If the refresh failed but an older copy exists, answer from it
+            return self._store.query(_parse_datetime(time_min), _parse_datetime(time_max))
+
+    @staticmethod
+    def _event_body(summary: str, start_time: str, end_time: str, description: str = ""):
+        return {
             'summary': summary,
             'description': description,
             'start': {
@@ -72,14 +256,21 @@ class GoogleCalendarClient:
             },
         }
 
+    def create_event(self, summary: str, start_time: str, end_time: str, description: str = ""):
+        """Creates an event on the calendar."""
+        event = self._event_body(summary, start_time, end_time, description)
+
         try:
-            event = self.service.events().insert(calendarId='primary', body=event).execute()
-            return event
+            event = self.pool.execute(lambda service: service.events().insert(calendarId='primary', body=event))
         except HttpError as error:
             print(f'An error occurred: {error}')
             return None
+        with self._lock:
+            # Write-through so the next availability check already sees the new event
+            self._store.apply(event)
+        return event
 
-    def check_availability(self, date_str: str):
+    def check_availability(self, date_str: str, force_refresh: bool = False):
         """
         Checks availability for a specific date.
         date_str should be in 'YYYY-MM-DD' format.
@@ -88,7 +279,7 @@ class GoogleCalendarClient:
         time_min = f"{date_str}T08:00:00-03:00"
         time_max = f"{date_str}T18:00:00-03:00"
         
-        events = self.list_events(time_min, time_max)
+        events = self.list_events(time_min, time_max, force_refresh=force_refresh)
         
         if not events:
             return f"O dia {date_str} está totalmente disponível das 08:00 às 18:00."
@@ -106,3 +297,137 @@ class GoogleCalendarClient:
                 busy_slots.append(f"Dia todo: {event['summary']}")
         
         return f"No dia {date_str}, os seguintes horários já estão ocupados: " + ", ".join(busy_slots)
+
+    def free_busy(self, time_min: str, time_max: str, calendar_ids=None):
+        """
+        Returns the busy intervals of one or more calendars with a single freebusy().query call,
+        as {calendar_id: [(start, end), ...]}. Calendars that could not be read map to None.
+        """
+        calendar_ids = calendar_ids or ['primary']
+        body = {
+            'timeMin': time_min,
+            'timeMax': time_max,
+            'timeZone': 'America/Sao_Paulo',
+            'items': [{'id': calendar_id} for calendar_id in calendar_ids],
+        }
+        try:
+            result = self.pool.execute(lambda service: service.freebusy().query(body=body))
+        except HttpError as error:
+            print(f'An error occurred: {error}')
+            return {calendar_id: None for calendar_id in calendar_ids}
+
+        busy = {}
+        for calendar_id in calendar_ids:
+            info = result.get('calendars', {}).get(calendar_id, {})
+            if info.get('errors'):
+                busy[calendar_id] = None
+                continue
+            busy[calendar_id] = [
+                (_parse_datetime(slot['start']).astimezone(TZ), _parse_datetime(slot['end']).astimezone(TZ))
+                for slot in info.get('busy', [])
+            ]
+        return busy
+
+    def check_availability_range(self, start_date: str, end_date: str):
+        """
+        Checks availability for every day between start_date and end_date (inclusive,
+        'YYYY-MM-DD'), across the AVAILABILITY_CALENDARS, with a single free/busy request.
+        """
+        first = datetime.date.fromisoformat(start_date)
+        last = datetime.date.fromisoformat(end_date)
+        if last < first:
+            first, last = last, first
+        last = min(last, first + datetime.timedelta(days=MAX_RANGE_DAYS - 1))
+
+        busy_by_calendar = self.free_busy(
+            f"{first.isoformat()}T00:00:00-03:00",
+            f"{(last + datetime.timedelta(days=1)).isoformat()}T00:00:00-03:00",
+            AVAILABILITY_CALENDARS
+        )
+        unavailable = [calendar_id for calendar_id, busy in busy_by_calendar.items() if busy is None]
+        if len(unavailable) == len(busy_by_calendar):
+            return "Não foi possível consultar a disponibilidade no momento."
+
+        # Um horário está ocupado se estiver ocupado em qualquer um dos calendários
+        busy = sorted(slot for slots in busy_by_calendar.values() if slots for slot in slots)
+
+        lines = []
+        day = first
+        while day <= last:
+            # Horário comercial das 08:00 às 18:00
+            day_start = TZ.localize(datetime.datetime.combine(day, datetime.time(8)))
+            day_end = TZ.localize(datetime.datetime.combine(day, datetime.time(18)))
+            day_busy = []
+            for start, end in busy:
+                if start < day_end and end > day_start:
+                    start, end = max(start, day_start), min(end, day_end)
+                    if day_busy and start <= day_busy[-1][1]:
+                        day_busy[-1] = (day_busy[-1][0], max(day_busy[-1][1], end))
+                    else:
+                        day_busy.append((start, end))
+
+            if day_busy:
+                slots = ", ".join(f"{start.strftime('%H:%M')} às {end.strftime('%H:%M')}" for start, end in day_busy)
+                lines.append(f"- {day.isoformat()}: ocupado {slots}")
+            else:
+                lines.append(f"- {day.isoformat()}: totalmente disponível das 08:00 às 18:00")
+            day += datetime.timedelta(days=1)
+
+        header = f"Disponibilidade de {first.isoformat()} a {last.isoformat()} (08:00 às 18:00):"
+        if unavailable:
+            header += f" (não foi possível consultar: {', '.join(unavailable)})"
+        return header + "\n" + "\n".join(lines)
+
+    def find_free_slots(self, duration_minutes: int, date_from: str, date_to: str, limit: int = 5):
+        """
+        Finds the first `limit` free slots of `duration_minutes` between date_from and
+        date_to ('YYYY-MM-DD' or ISO datetimes), inside working hours, from the local
+        event store. Returns (start, end) pairs in America/Sao_Paulo time.
+        """
+        range_start = _parse_datetime(date_from)
+        range_end = _parse_datetime(date_to)
+        if 'T' not in date_to:
+            # A bare end date includes that whole day
+            range_end += datetime.timedelta(days=1)
+        range_start = max(range_start, datetime.datetime.now(TZ))
+        buffer = datetime.timedelta(minutes=SLOT_BUFFER_MINUTES)
+
+        refreshed = self.refresh()
+        with self._lock:
+            if not refreshed and not self._store.sync_token:
+                return None
+            busy = self._store.busy_intervals(range_start - buffer, range_end + buffer)
+
+        return find_free_slots(
+            busy, range_start, range_end, datetime.timedelta(minutes=duration_minutes),
+            work_start=WORK_START, work_end=WORK_END, work_days=WORK_DAYS, buffer=buffer,
+            step=datetime.timedelta(minutes=SLOT_STEP_MINUTES), limit=limit, tz=TZ
+        )
+
+    def describe_free_slots(self, duration_minutes: int, date_from: str, date_to: str, limit: int = 5):
+        """find_free_slots formatted as the Portuguese text returned to the agent."""
+        slots = self.find_free_slots(duration_minutes, date_from, date_to, limit)
+        if slots is None:
+            return "Não foi possível consultar a agenda no momento."
+        if not slots:
+            return f"Não há horários livres de {duration_minutes} minutos entre {date_from} e {date_to}."
+        lines = [f"- {start.strftime('%Y-%m-%d')} das {start.strftime('%H:%M')} às {end.strftime('%H:%M')} ({start.isoformat()})"
+                 for start, end in slots]
+        return f"Horários livres de {duration_minutes} minutos:\n" + "\n".join(lines)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_calendar_client():
+    """
+    Returns the shared GoogleCalendarClient, creating it on first use.
+    Authentication (token files, OAuth refresh) happens here rather than at import time.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GoogleCalendarClient()
+    return _client
@@ -0,0 +1,87 @@
+import bisect
+import datetime
+import pytz
+
+TZ = pytz.timezone("America/Sao_Paulo")
+
+
+def merge_intervals(intervals):
+    """Merges overlapping or touching (start, end) intervals; returns them sorted by start."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(window_start, window_end, busy, starts=None):
+    """
+    Free intervals of [window_start, window_end) once the merged, sorted `busy`
+    intervals are removed. `starts` (the busy start times) may be passed in to
+    avoid rebuilding it for every window.
+    """
+    if starts is None:
+        starts = [start for start, _ in busy]
+    # Merged intervals don't overlap, so only the one just before window_start can reach into it
+    i = max(bisect.bisect_left(starts, window_start) - 1, 0)
+
+    free = []
+    cursor = window_start
+    while i < len(busy) and busy[i][0] < window_end:
+        start, end = busy[i]
+        if end > cursor:
+            if start > cursor:
+                free.append((cursor, start))
+            cursor = end
+        i += 1
+    if cursor < window_end:
+        free.append((cursor, window_end))
+    return free
+
+
+def _round_up(moment, step: datetime.timedelta):
+    """Rounds an aware datetime up to the next multiple of `step` past the hour."""
+    base = moment.replace(minute=0, second=0, microsecond=0)
+    offset = moment - base
+    steps = -(-offset // step)  # ceil division of timedeltas
+    return base + steps * step
+
+
+def find_free_slots(busy, range_start, range_end, duration: datetime.timedelta,
+                    work_start=datetime.time(8), work_end=datetime.time(18),
+                    work_days=(0, 1, 2, 3, 4, 5, 6), buffer=datetime.timedelta(0),
+                    step=datetime.timedelta(minutes=30), limit: int = 5, max_per_day: int = 3, tz=TZ):
+    """
+    Returns up to `limit` free (start, end) slots of length `duration` between
+    range_start and range_end, inside working hours on working days (weekday(),
+    Monday = 0), keeping `buffer` clear around every busy interval. Slot starts
+    are aligned to `step` and at most `max_per_day` slots are offered per day so
+    the suggestions spread across days.
+    """
+    # Everything in `tz`: a slot starting where a busy event ends inherits that event's
+    # offset, and both the step alignment and the hour shown to the user follow it
+    range_start, range_end = range_start.astimezone(tz), range_end.astimezone(tz)
+    busy = merge_intervals((start.astimezone(tz) - buffer, end.astimezone(tz) + buffer) for start, end in busy)
+    starts = [start for start, _ in busy]
+
+    slots = []
+    day = range_start.date()
+    last_day = range_end.date()
+    while day <= last_day and len(slots) < limit:
+        if day.weekday() in work_days:
+            day_start = max(tz.localize(datetime.datetime.combine(day, work_start)), range_start)
+            day_end = min(tz.localize(datetime.datetime.combine(day, work_end)), range_end)
+            per_day = 0
+            for free_start, free_end in subtract_intervals(day_start, day_end, busy, starts):
+                slot_start = _round_up(free_start, step)
+                while slot_start + duration <= free_end and per_day < max_per_day and len(slots) < limit:
+                    slots.append((slot_start, slot_start + duration))
+                    per_day += 1
+                    slot_start += max(step, duration)
+                if per_day >= max_per_day or len(slots) >= limit:
+                    break
+        day += datetime.timedelta(days=1)
+    return slots
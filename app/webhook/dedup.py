@@ -0,0 +1,53 @@
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from app.database.mongodb import async_db_manager
+
+load_dotenv()
+
+# Number of recent message ids kept in memory for the hot path
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "10000"))
+
+
+class MessageDeduplicator:
+    """
+    Rejects re-delivered Evolution messages (same data.key.id).
+
+    An in-memory LRU answers repeats seen by this process; the Mongo
+    `processed_messages` collection (unique _id + TTL) covers restarts and
+    other replicas.
+    """
+
+    def __init__(self, max_size: int = DEDUP_CACHE_SIZE):
+        self.max_size = max_size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen_locally(self, message_id: str):
+        """Checks the LRU and records the id; True means it is a duplicate."""
+        with self._lock:
+            if message_id in self._seen:
+                self._seen.move_to_end(message_id)
+                return True
+            self._seen[message_id] = None
+            if len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+            return False
+
+    def forget(self, message_id: str):
+        """Drops the id from the LRU so a re-delivery is accepted (the message was not stored)."""
+        with self._lock:
+            self._seen.pop(message_id, None)
+
+    async def claim(self, message_id: str):
+        """True if this is the first delivery of the message (checked in Mongo, on the event loop)."""
+        try:
+            return await async_db_manager.claim_message(message_id)
+        except Exception as e:
+            # Fail open: better to risk a duplicate than to drop a message when Mongo is unreachable
+            print(f"Dedup store unavailable, accepting message {message_id}: {e}")
+            return True
+
+
+deduplicator = MessageDeduplicator()
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from app.agent.assistant import AGENT_TURN_DEADLINE_SECONDS, process_message
+from app.webhook.evolution_api import evolution_client
+
+load_dotenv()
+
+# Maximum number of agent turns (different users) running at the same time
+MAX_CONCURRENCY = int(os.getenv("DISPATCHER_MAX_CONCURRENCY", "8"))
+# Quiet period that closes a burst of messages from the same user (0 disables coalescing)
+BURST_WINDOW_SECONDS = float(os.getenv("BURST_WINDOW_SECONDS", "2.0"))
+# Longest a burst can keep growing, counted from its first message, before the turn starts anyway
+BURST_MAX_WAIT_SECONDS = float(os.getenv("BURST_MAX_WAIT_SECONDS", "10.0"))
+
+
+class MessageDispatcher:
+    """
+    Hands incoming WhatsApp messages to background workers.
+
+    Messages from the same remoteJid are processed strictly in arrival order,
+    while different users run in parallel up to `max_concurrency` turns.
+    A burst of messages from one user (no gap longer than `burst_window`) is
+    merged into a single agent turn, but never held longer than
+    `burst_max_wait` after its first message; messages that arrive while a
+    turn is running join the next batch.
+    """
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY, burst_window: float = BURST_WINDOW_SECONDS,
+                 burst_max_wait: float = BURST_MAX_WAIT_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.burst_window = burst_window
+        self.burst_max_wait = burst_max_wait
+        self._queues = {}   # remote_jid -> deque of (text, enqueued_at)
+        self._last_arrival = {}  # remote_jid -> monotonic time of the latest message
+        self._workers = {}  # remote_jid -> asyncio.Task draining that queue
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="agent")
+        self._in_flight = 0
+        self._processed = 0
+        self._failed = 0
+        self._coalesced = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._last_wait = 0.0
+
+    def submit(self, remote_jid: str, text: str):
+        """Enqueues a message and returns the current queue depth for that user."""
+        queue = self._queues.setdefault(remote_jid, deque())
+        now = time.monotonic()
+        queue.append((text, now))
+        self._last_arrival[remote_jid] = now
+        if remote_jid not in self._workers:
+            self._workers[remote_jid] = asyncio.create_task(self._drain(remote_jid))
+        return len(queue)
+
+    async def _drain(self, remote_jid: str):
+        queue = self._queues[remote_jid]
+        try:
+            while queue:
+                await self._wait_for_quiet(remote_jid)
+                async with self._semaphore:
+                    # Everything that arrived up to now becomes one turn
+                    batch = list(queue)
+                    queue.clear()
+                    self._coalesced += len(batch) - 1
+                    self._record_wait(time.monotonic() - batch[0][1])
+                    # The turn deadline counts from the oldest message, so time spent queued here counts too
+                    deadline = batch[0][1] + AGENT_TURN_DEADLINE_SECONDS
+                    await self._run_turn(remote_jid, "\n".join(text for text, _ in batch), deadline)
+        finally:
+            # No await between the last emptiness check and here, so a message
+            # submitted concurrently always finds either this worker or none.
+            self._workers.pop(remote_jid, None)
+            self._queues.pop(remote_jid, None)
+            self._last_arrival.pop(remote_jid, None)
+
+    async def _wait_for_quiet(self, remote_jid: str):
+        """
+        Sleeps until no new message from this user has arrived for `burst_window` seconds,
+        or until `burst_max_wait` has passed since the oldest queued message, so a user who
+        keeps typing still gets a turn.
+        """
+        give_up = self._queues[remote_jid][0][1] + self.burst_max_wait
+        while True:
+            now = time.monotonic()
+            remaining = min(self._last_arrival[remote_jid] + self.burst_window, give_up) - now
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    async def _run_turn(self, remote_jid: str, text: str, deadline: float):
+        loop = asyncio.get_running_loop()
+        self._in_flight += 1
+        try:
+            # Process with AI Agent (passando o remote_jid como user_id para a memória)
+            response_text = await loop.run_in_executor(self._executor, process_message, remote_jid, text, deadline)
+            print(f"Agent response: {response_text}")
+
+            # Send back to WhatsApp using the full remote_jid
+            if response_text:
+                await evolution_client.send_async(remote_jid, response_text)
+            self._processed += 1
+        except Exception as e:
+            self._failed += 1
+            print(f"Error processing message from {remote_jid}: {e}")
+        finally:
+            self._in_flight -= 1
+
+    def _record_wait(self, wait: float):
+        self._last_wait = wait
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+
+    def stats(self):
+        """Queue depth and wait time snapshot."""
+        started = self._processed + self._failed + self._in_flight
+        return {
+            "queued": sum(len(q) for q in self._queues.values()),
+            "active_users": len(self._workers),
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "processed": self._processed,
+            "failed": self._failed,
+            "coalesced": self._coalesced,
+            "wait_seconds": {
+                "last": round(self._last_wait, 4),
+                "avg": round(self._wait_total / started, 4) if started else 0.0,
+                "max": round(self._wait_max, 4),
+            },
+        }
+
+    async def shutdown(self, timeout: float = 30.0):
+        """Waits for the queued turns to finish, then releases the worker threads."""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+        self._executor.shutdown(wait=False)
+
+
+dispatcher = MessageDispatcher()
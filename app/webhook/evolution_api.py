@@ -1,6 +1,14 @@
+import asyncio
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from dotenv import load_dotenv
+from app.telemetry import timed
 
 load_dotenv()
 
@@ -8,26 +16,148 @@ EVOLUTION_API_URL = os.getenv("EVOLUTION_API_URL")
 EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY")
 INSTANCE_NAME = os.getenv("EVOLUTION_INSTANCE_NAME")
 
-def send_whatsapp_message(number: str, text: str):
-    # Evolution v2 often prefers just the numbers without @s.whatsapp.net
-    clean_number = number.split("@")[0]
-    
-    url = f"{EVOLUTION_API_URL}/message/sendText/{INSTANCE_NAME}"
-    headers = {
-        "apikey": EVOLUTION_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "number": clean_number,
-        "text": text
-    }
-    
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code != 201 and response.status_code != 200:
-            print(f"Error Evolution API: {response.status_code} - {response.text}")
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        print(f"Error sending message: {e}")
-        return None
+# Sender tuning
+EVOLUTION_POOL_SIZE = int(os.getenv("EVOLUTION_POOL_SIZE", "10"))
+EVOLUTION_RATE_LIMIT = float(os.getenv("EVOLUTION_RATE_LIMIT", "20"))  # messages per second per instance
+EVOLUTION_MAX_RETRIES = int(os.getenv("EVOLUTION_MAX_RETRIES", "3"))
+EVOLUTION_CONNECT_TIMEOUT = float(os.getenv("EVOLUTION_CONNECT_TIMEOUT", "5"))
+EVOLUTION_READ_TIMEOUT = float(os.getenv("EVOLUTION_READ_TIMEOUT", "15"))
+
+
+
+class EvolutionAPIError(Exception):
+    """
+    Raised when a message could not be delivered to the Evolution API.
+    `retryable` is False when the message may already have been sent (read
+    timeout, 5xx): sending it again could duplicate it on WhatsApp.
+    """
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _not_sent(error: requests.RequestException):
+    """True if the request never reached the server (connect timeout, refused, DNS), so resending is safe."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    return float(value) if value and value.isdigit() else None
+
+
+class RateLimiter:
+    """Thread-safe token bucket; `acquire` blocks the calling sender thread until a token is free."""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class EvolutionClient:
+    """
+    Outbound WhatsApp sender for one Evolution API instance.
+
+    Keeps a pooled keep-alive session, applies timeouts, rate-limits per
+    instance and retries 429/5xx with exponential backoff. Retries and rate
+    limiting happen on the client's own sender threads, so callers using
+    `send_nowait` or `send_async` are never blocked.
+    """
+
+    def __init__(self, base_url: str = EVOLUTION_API_URL, api_key: str = EVOLUTION_API_KEY,
+                 instance: str = INSTANCE_NAME, pool_size: int = EVOLUTION_POOL_SIZE,
+                 rate_limit: float = EVOLUTION_RATE_LIMIT, max_retries: int = EVOLUTION_MAX_RETRIES,
+                 backoff: float = 0.5, limiter: RateLimiter = None):
+        self.url = f"{base_url}/message/sendText/{instance}"
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = (EVOLUTION_CONNECT_TIMEOUT, EVOLUTION_READ_TIMEOUT)
+        # Pass another client's limiter to share the instance's rate limit with it
+        self.limiter = limiter or RateLimiter(rate_limit)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "apikey": api_key,
+            "Content-Type": "application/json"
+        })
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="evolution")
+
+    @timed("evolution_send")
+    def send(self, number: str, text: str):
+        """Sends a text message, blocking until delivered. Raises EvolutionAPIError on failure."""
+        # Evolution v2 often prefers just the numbers without @s.whatsapp.net
+        payload = {
+            "number": number.split("@")[0],
+            "text": text
+        }
+
+        # sendText is not idempotent: only retry when the message certainly was not accepted
+        # (no connection, 429, or 503 with Retry-After); a read timeout or other 5xx may
+        # already have delivered it
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            retry_after = None
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                error, retryable = e, _not_sent(e)
+            else:
+                if 200 <= response.status_code < 300:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        # Delivered; the body is only informative
+                        return None
+                error = f"{response.status_code} - {response.text}"
+                retry_after = _retry_after(response)
+                retryable = response.status_code == 429 or (response.status_code == 503 and retry_after is not None)
+
+            if not retryable:
+                break
+            if attempt < self.max_retries:
+                delay = self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                print(f"Evolution API retry {attempt + 1}/{self.max_retries} in {delay:.1f}s: {error}")
+                time.sleep(delay)
+
+        raise EvolutionAPIError(f"Error Evolution API: {error}", retryable=retryable)
+
+    def send_nowait(self, number: str, text: str):
+        """Queues a message on the sender pool and returns a concurrent Future."""
+        return self._executor.submit(self.send, number, text)
+
+    async def send_async(self, number: str, text: str):
+        """Awaitable send for the asyncio side (webhook dispatcher)."""
+        return await asyncio.wrap_future(self.send_nowait(number, text))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+
+evolution_client = EvolutionClient()
@@ -1,40 +1,117 @@
-from fastapi import APIRouter, Request, HTTPException
-from app.agent.assistant import process_message
-from app.webhook.evolution_api import send_whatsapp_message
+import logging
+import os
+import re
+import sys
+import orjson
+from fastapi import APIRouter, Request
+from pydantic import ValidationError
+from app.webhook.dispatcher import dispatcher
+from app.webhook.dedup import deduplicator
+from app.database.mongodb import async_db_manager
+from app.model.schemas import EvolutionWebhook
+from app.telemetry import timed
+
+# inline: this process runs the agent turns; queue: messages go to a durable
+# Mongo queue consumed by worker.py processes
+INGEST_MODE = os.getenv("INGEST_MODE", "inline")
+# DEBUG logs every payload (ignored ones included), INFO each accepted message, WARNING only problems
+WEBHOOK_LOG_LEVEL = os.getenv("WEBHOOK_LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("calendar_agent.webhook")
+logger.setLevel(WEBHOOK_LOG_LEVEL)
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+# Byte patterns for the pre-filter. Quotes inside JSON strings are escaped, so
+# these only match keys and values of the payload itself, never message text.
+_UPSERT_EVENT = b'"messages.upsert"'
+_EVENT_NAME = re.compile(rb'"event"\s*:\s*"([^"]*)"')
+_FROM_ME = re.compile(rb'"fromMe"\s*:\s*true')
+_TEXT_FIELDS = (b'"conversation"', b'"extendedTextMessage"')
+# Status updates and group chats arrive as messages.upsert too; the agent only talks 1:1
+_IGNORED_JID_SUFFIXES = ("@broadcast", "@g.us")
 
 router = APIRouter()
 
+
+def _prefilter(body: bytes):
+    """
+    Reason to drop the payload without decoding it, or None if it may be a text
+    message for the agent. Evolution also posts presence, receipts, status and
+    group updates to this URL; they are most of the traffic and never need parsing.
+    """
+    if _UPSERT_EVENT not in body:
+        match = _EVENT_NAME.search(body)
+        return {"status": "ignored", "event": match.group(1).decode(errors="replace") if match else None}
+    if _FROM_ME.search(body):
+        # Avoid responding to our own messages
+        return {"status": "ignored", "reason": "own_message"}
+    if not any(field in body for field in _TEXT_FIELDS):
+        return {"status": "ignored", "reason": "not_text"}
+    return None
+
+
 @router.post("/webhook")
+@timed("webhook")
 async def evolution_webhook(request: Request):
-    data = await request.json()
-    print(f"Received webhook: {data}")
-
-    # Evolution API sends 'messages.upsert' event for new messages
-    event = data.get("event")
-    if event == "messages.upsert":
-        message_data = data.get("data", {})
-        key = message_data.get("key", {})
-        from_me = key.get("fromMe", False)
-        
-        # Avoid responding to our own messages
-        if from_me:
-            return {"status": "ignored", "reason": "own_message"}
-
-        remote_jid = key.get("remoteJid")
-        # Text message is usually in message.conversation or message.extendedTextMessage.text
-        message = message_data.get("message", {})
-        text = message.get("conversation") or message.get("extendedTextMessage", {}).get("text")
-
-        if text and remote_jid:
-            print(f"Message from {remote_jid}: {text}")
-            
-            # Process with AI Agent (passando o remote_jid como user_id para a memória)
-            response_text = process_message(remote_jid, text)
-            print(f"Agent response: {response_text}")
-            
-            # Send back to WhatsApp using the full remote_jid
-            send_whatsapp_message(remote_jid, response_text)
-            
-            return {"status": "success"}
-
-    return {"status": "ignored", "event": event}
+    body = await request.body()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received webhook: %s", body.decode(errors="replace"))
+
+    ignored = _prefilter(body)
+    if ignored:
+        return ignored
+
+    try:
+        payload = EvolutionWebhook.model_validate(orjson.loads(body))
+    except (orjson.JSONDecodeError, ValidationError) as e:
+        # 200, not 4xx: Evolution would keep re-delivering a payload that can never be parsed
+        logger.warning("Invalid webhook payload: %s", e)
+        return {"status": "ignored", "reason": "invalid_payload"}
+
+    # The pre-filter only rejects what it is sure about; the parsed payload decides the rest
+    if payload.event != "messages.upsert":
+        return {"status": "ignored", "event": payload.event}
+    key = payload.data.key
+    if key.fromMe:
+        return {"status": "ignored", "reason": "own_message"}
+    if key.remoteJid.endswith(_IGNORED_JID_SUFFIXES):
+        return {"status": "ignored", "reason": "not_direct_chat"}
+    text = payload.data.message.text if payload.data.message else None
+    if not text:
+        return {"status": "ignored", "reason": "not_text"}
+
+    remote_jid, message_id = key.remoteJid, key.id
+    # Evolution re-delivers messages.upsert on timeouts: drop repeats before any LLM/Calendar work
+    if message_id and deduplicator.seen_locally(message_id):
+        return {"status": "ignored", "reason": "duplicate"}
+
+    if INGEST_MODE == "queue":
+        # Persisted before acknowledging, so a restart never loses an accepted message. The
+        # queue is keyed by message id, so it is also the dedup store: no separate claim that
+        # could outlive a failed enqueue and make Evolution's re-delivery look like a duplicate
+        try:
+            queued = await async_db_manager.enqueue_inbound(remote_jid, text, message_id)
+        except Exception:
+            if message_id:
+                deduplicator.forget(message_id)
+            raise
+        if not queued:
+            return {"status": "ignored", "reason": "duplicate"}
+        logger.info("Message from %s: %s", remote_jid, text)
+        return {"status": "queued"}
+
+    if message_id and not await deduplicator.claim(message_id):
+        return {"status": "ignored", "reason": "duplicate"}
+    logger.info("Message from %s: %s", remote_jid, text)
+
+    # Acknowledge right away; the agent turn and the reply run in the background
+    depth = dispatcher.submit(remote_jid, text)
+    return {"status": "queued", "queue_depth": depth}
+
+@router.get("/webhook/stats")
+async def webhook_stats():
+    return dispatcher.stats()
@@ -0,0 +1 @@
+from .agent_worker import AgentWorker
@@ -0,0 +1,171 @@
+import datetime
+import os
+import random
+import signal
+import threading
+import time
+from pymongo.errors import PyMongoError
+from app.agent.assistant import AGENT_TURN_DEADLINE_SECONDS, process_message
+from app.agent.context import load_encoding
+from app.database.mongodb import db_manager
+from app.followup.tasks import WORKER_ID, outbox_sender
+from app.scheduler import start_notification_timers, stop_notification_timers
+from app.tool.google_calendar import get_calendar_client
+
+# Turnos processados em paralelo por processo worker
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+# Intervalo de polling da fila quando change streams não estão disponíveis (MongoDB sem replica set)
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "1"))
+# Tempo que um worker fica com a conversa de um usuário; se ele cair, outro a retoma depois disso
+INBOUND_LEASE_SECONDS = int(os.getenv("INBOUND_LEASE_SECONDS", "180"))
+INBOUND_MAX_ATTEMPTS = int(os.getenv("INBOUND_MAX_ATTEMPTS", "3"))
+
+
+class AgentWorker:
+    """
+    Consome a fila durável de mensagens recebidas (inbound_messages) gravada pelo
+    webhook quando INGEST_MODE=queue.
+
+    Cada thread reserva a conversa de um usuário, junta as mensagens pendentes dele
+    em um turno (como o dispatcher faz no modo inline), roda o agente e grava a
+    resposta na outbox, que cuida da entrega com retry. Só então as mensagens são
+    confirmadas (ack). Se o processo cair no meio, a reserva expira e outro worker
+    refaz o turno; a resposta tem _id determinístico na outbox, então não é enviada
+    duas vezes. Falhas liberam a conversa com backoff exponencial, até
+    INBOUND_MAX_ATTEMPTS.
+
+    Novas mensagens acordam as threads por change stream; sem replica set, a fila é
+    consultada a cada WORKER_POLL_SECONDS.
+    """
+
+    def __init__(self, owner: str = WORKER_ID, threads: int = WORKER_THREADS):
+        self.owner = owner
+        self.threads = threads
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._retried = 0
+        self._failed = 0
+
+    def start(self):
+        if self._threads:
+            return
+        db_manager.ensure_indexes()
+        # As respostas saem pela outbox; o sender local entrega sem esperar o polling
+        outbox_sender.start()
+        # Agendamentos feitos aqui ganham timers aqui: sem o scheduler rodando, os lembretes
+        # só sairiam na varredura do processo web, até NOTIFICATION_SWEEP_MINUTES atrasados
+        restored = start_notification_timers()
+        print(f"⏰ Timers de notificação ativos ({restored} agendamentos pendentes)")
+        try:
+            # Autoriza o Google antes do primeiro turno, que tem prazo
+            get_calendar_client()
+        except Exception as e:
+            print(f"Erro ao autenticar no Google Calendar: {e}")
+        load_encoding()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._run, name=f"agent-worker-{i}")
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._watch, name="agent-worker-watch", daemon=True).start()
+
+    def stop(self):
+        """Para de reservar conversas e espera os turnos em andamento terminarem."""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        stop_notification_timers()
+        outbox_sender.stop()
+
+    def run_forever(self):
+        # SIGTERM (docker stop, systemd) encerra como Ctrl+C: termina os turnos em andamento
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop.set())
+        self.start()
+        print(f"👷 Worker {self.owner} consumindo a fila com {self.threads} threads")
+        try:
+            while not self._stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def _watch(self):
+        try:
+            for _ in db_manager.watch_inbound():
+                self._wake.set()
+                if self._stop.is_set():
+                    return
+        except Exception as e:
+            print(f"Change streams indisponíveis ({e}); usando polling a cada {WORKER_POLL_SECONDS}s")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                conversation = db_manager.claim_inbound_conversation(self.owner, INBOUND_LEASE_SECONDS)
+            except PyMongoError as e:
+                print(f"Erro ao ler a fila de entrada: {e}")
+                conversation = None
+
+            if conversation is None:
+                self._wake.wait(WORKER_POLL_SECONDS)
+                self._wake.clear()
+                continue
+            self._process(conversation)
+
+    def _process(self, conversation: dict):
+        user_id = conversation["_id"]
+        # Só as mensagens lidas para este turno: as que chegarem depois ficam para o próximo
+        message_ids = None
+        try:
+            messages = db_manager.get_pending_inbound(user_id)
+            message_ids = [m["_id"] for m in messages]
+            if messages:
+                # O prazo do turno conta desde a mensagem mais antiga, como no dispatcher
+                age = (datetime.datetime.now(datetime.timezone.utc) - messages[0]["received_at"]).total_seconds()
+                deadline = time.monotonic() + AGENT_TURN_DEADLINE_SECONDS - age
+                response_text = process_message(user_id, "\n".join(m["text"] for m in messages), deadline)
+                if response_text:
+                    db_manager.enqueue_notification(
+                        f"inbound:{messages[-1]['_id']}", "reply", user_id, response_text,
+                        messages[0]["received_at"]
+                    )
+                    outbox_sender.notify()
+            db_manager.ack_inbound(conversation, self.owner, message_ids)
+            with self._lock:
+                self._processed += 1
+        except Exception as e:
+            self._fail(conversation, message_ids, e)
+
+    def _fail(self, conversation: dict, message_ids, error: Exception):
+        user_id = conversation["_id"]
+        attempts = conversation.get("attempts", 1)
+        try:
+            # Sem a lista do turno (a leitura falhou) não há o que descartar: tenta de novo
+            if attempts >= INBOUND_MAX_ATTEMPTS and message_ids is not None:
+                print(f"❌ Mensagens de {user_id} descartadas após {attempts} tentativas: {error}")
+                db_manager.ack_inbound(conversation, self.owner, message_ids, status="failed")
+                with self._lock:
+                    self._failed += 1
+            else:
+                delay = min(2 ** attempts * 2, 60) + random.uniform(0, 1)
+                print(f"Erro no turno de {user_id} (tentativa {attempts}), nova tentativa em {delay:.0f}s: {error}")
+                retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay)
+                db_manager.retry_inbound(conversation, self.owner, str(error), retry_at)
+                with self._lock:
+                    self._retried += 1
+        except PyMongoError as e:
+            # Sem banco não há como liberar: a reserva expira e outro worker retoma a conversa
+            print(f"Erro ao registrar a falha de {user_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "owner": self.owner,
+                "threads": self.threads,
+                "processed": self._processed,
+                "retried": self._retried,
+                "failed": self._failed,
+            }
@@ -0,0 +1,556 @@
+"""
+Offline load and latency benchmark for the webhook -> agent -> Calendar -> Evolution path.
+
+Everything runs on one machine: the app is served by uvicorn on a local port and
+the external services are replaced by local stand-ins with configurable latency:
+
+- OpenAI chat completions: HTTP server speaking the /v1/chat/completions protocol
+- Evolution API sendText: HTTP server that records when each reply arrives
+- Google Calendar API: in-process fake of the googleapiclient service object
+- MongoDB: mongomock with per-operation latency (or a real server via --mongo-uri)
+
+Usage:
+    python benchmarks/webhook_load.py --users 50 --messages 4
+    python benchmarks/webhook_load.py --openai-latency 0.8 --json bench_output.txt
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import functools
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class StageRecorder:
+    """Thread-safe collection of latency samples per stage."""
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage: str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+    def summary(self):
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+        return {stage: _percentiles(values) for stage, values in samples.items()}
+
+
+def _percentiles(values):
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "count": len(values),
+        "p50_ms": round(pick(0.50) * 1000, 2),
+        "p95_ms": round(pick(0.95) * 1000, 2),
+        "p99_ms": round(pick(0.99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+        "mean_ms": round(statistics.fmean(values) * 1000, 2),
+    }
+
+
+def _sleep(latency: float, jitter: float):
+    if latency > 0:
+        time.sleep(max(0.0, random.gauss(latency, latency * jitter)))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve(handler_class, port: int):
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+    server.daemon_threads = True
+    # Clients that gave up (timeouts) close the socket mid-response; that is expected under load
+    server.handle_error = lambda request, client_address: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- OpenAI stand-in -------------------------------------------------------
+
+class RequestWindow:
+    """Fixed one-minute request quota, reported the way OpenAI does (x-ratelimit-* headers, 429)."""
+
+    def __init__(self, rpm: int):
+        self.rpm = rpm
+        self._started = time.monotonic()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Returns (allowed, headers)."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._started >= 60:
+                self._started, self._used = now, 0
+            reset = 60 - (now - self._started)
+            allowed = self._used < self.rpm
+            if allowed:
+                self._used += 1
+            headers = {
+                "x-ratelimit-limit-requests": str(self.rpm),
+                "x-ratelimit-remaining-requests": str(self.rpm - self._used),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+            }
+            if not allowed:
+                headers["retry-after"] = str(max(1, int(reset)))
+            return allowed, headers
+
+
+def make_openai_handler(latency: float, jitter: float, rpm: int = 0):
+    window = RequestWindow(rpm) if rpm > 0 else None
+
+    class OpenAIHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            allowed, headers = window.take() if window else (True, {})
+            if not allowed:
+                self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                                "code": "rate_limit_exceeded"}}, headers)
+                return
+            _sleep(latency, jitter)
+            messages = body["messages"]
+            last = messages[-1]
+            message = {"role": "assistant", "content": None}
+            finish_reason = "stop"
+
+            if not body.get("tools"):
+                # Summary requests (no tools) just get text back
+                message["content"] = "Resumo sintético da conversa."
+            elif last["role"] == "tool":
+                message["content"] = "Pronto! Verifiquei a agenda para você."
+            else:
+                tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+                if "marcar" in (last.get("content") or ""):
+                    name, args = "book_appointment", {
+                        "summary": "Reunião de benchmark",
+                        "start_time": f"{tomorrow}T10:00:00-03:00",
+                        "end_time": f"{tomorrow}T11:00:00-03:00",
+                    }
+                else:
+                    name, args = "check_availability", {"date": tomorrow}
+                message["tool_calls"] = [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(args)},
+                }]
+                finish_reason = "tool_calls"
+
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4o"),
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": 500, "completion_tokens": 30, "total_tokens": 530},
+            }, headers)
+
+    return OpenAIHandler
+
+
+# --- Evolution stand-in ----------------------------------------------------
+
+def make_evolution_handler(latency: float, jitter: float, replies: dict, replies_lock: threading.Lock,
+                           reply_texts: Counter):
+    class EvolutionHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            _sleep(latency, jitter)
+            with replies_lock:
+                replies.setdefault(body["number"], []).append(time.perf_counter())
+                reply_texts[body["text"]] += 1
+            payload = json.dumps({"key": {"id": uuid.uuid4().hex}, "status": "PENDING"}).encode()
+            self.send_response(201)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return EvolutionHandler
+
+
+# --- Google Calendar stand-in ----------------------------------------------
+
+class _FakeRequest:
+    def __init__(self, result, latency, jitter, recorder, stage):
+        self._result = result
+        self._latency = latency
+        self._jitter = jitter
+        self._recorder = recorder
+        self._stage = stage
+
+    def execute(self):
+        start = time.perf_counter()
+        _sleep(self._latency, self._jitter)
+        self._recorder.add(self._stage, time.perf_counter() - start)
+        return self._result() if callable(self._result) else self._result
+
+
+class FakeCalendarService:
+    """Mimics the parts of the googleapiclient Calendar v3 service used by GoogleCalendarClient."""
+
+    def __init__(self, latency: float, jitter: float, recorder: StageRecorder):
+        self.latency = latency
+        self.jitter = jitter
+        self.recorder = recorder
+
+    def _request(self, result):
+        return _FakeRequest(result, self.latency, self.jitter, self.recorder, "calendar_api")
+
+    def events(self):
+        service = self
+
+        class Events:
+            def list(self, **params):
+                return service._request({"items": [], "nextSyncToken": uuid.uuid4().hex})
+
+            def insert(self, calendarId, body):
+                def created():
+                    event_id = uuid.uuid4().hex
+                    return {**body, "id": event_id, "status": "confirmed",
+                            "htmlLink": f"https://calendar.example/event?eid={event_id}"}
+                return service._request(created)
+
+        return Events()
+
+    def freebusy(self):
+        service = self
+
+        class FreeBusy:
+            def query(self, body):
+                return service._request({"calendars": {item["id"]: {"busy": []} for item in body["items"]}})
+
+        return FreeBusy()
+
+
+# --- MongoDB stand-in ------------------------------------------------------
+
+class AsyncMongomock:
+    """
+    Stand-in for AsyncMongoClient over one shared mongomock client. Every
+    DatabaseManager and AsyncDatabaseManager operation ends up here, so both see
+    the same data; latency is slept on the calling event loop instead of
+    blocking it, and the mongomock calls themselves (not thread-safe) are
+    serialised with a lock.
+    """
+
+    def __init__(self, sync_client, lock, latency: float, jitter: float, recorder: StageRecorder):
+        self._sync_client = sync_client
+        self._lock = lock
+        self._latency = latency
+        self._jitter = jitter
+        self._recorder = recorder
+
+    async def _call(self, function, *args, **kwargs):
+        start = time.perf_counter()
+        await asyncio.sleep(max(0.0, random.gauss(self._latency, self._latency * self._jitter)))
+        with self._lock:
+            result = function(*args, **kwargs)
+        self._recorder.add("mongo", time.perf_counter() - start)
+        return result
+
+    def get_database(self):
+        return _AsyncProxy(self, self._sync_client.get_database())
+
+    async def close(self):
+        pass
+
+
+class _AsyncProxy:
+    """Database or collection: methods become awaitable, find() returns an async cursor."""
+
+    def __init__(self, client, target):
+        self._client = client
+        self._target = target
+
+    def get_collection(self, name):
+        return _AsyncProxy(self._client, self._target.get_collection(name))
+
+    def find(self, *args, **kwargs):
+        return _AsyncCursor(self._client, self._target.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await self._client._call(attribute, *args, **kwargs)
+        return call
+
+
+class _AsyncCursor:
+    def __init__(self, client, cursor):
+        self._client = client
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, limit: int):
+        self._cursor.limit(limit)
+        return self
+
+    async def to_list(self, length=None):
+        documents = await self._client._call(list, self._cursor)
+        return documents if length is None else documents[:length]
+
+    async def __aiter__(self):
+        for document in await self.to_list():
+            yield document
+
+
+# --- Benchmark -------------------------------------------------------------
+
+USER_TEXTS = ["oi, tem horário amanhã?", "de manhã seria melhor", "pode marcar às 10h então"]
+
+
+def run(args):
+    recorder = StageRecorder()
+    replies = {}
+    reply_texts = Counter()
+    replies_lock = threading.Lock()
+
+    openai_port, evolution_port, app_port = _free_port(), _free_port(), _free_port()
+    _serve(make_openai_handler(args.openai_latency, args.jitter, args.openai_rpm), openai_port)
+    _serve(make_evolution_handler(args.evolution_latency, args.jitter, replies, replies_lock, reply_texts), evolution_port)
+
+    # The app reads its configuration from the environment at import time
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "EVOLUTION_API_URL": f"http://127.0.0.1:{evolution_port}",
+        "EVOLUTION_API_KEY": "bench",
+        "EVOLUTION_INSTANCE_NAME": "bench",
+        "EVOLUTION_RATE_LIMIT": str(args.evolution_rate),
+        "DISPATCHER_MAX_CONCURRENCY": str(args.concurrency),
+        "BURST_WINDOW_SECONDS": str(args.burst_window),
+        "MONGO_URI": args.mongo_uri or "mongodb://localhost:27017/calendar_agent_bench",
+        "WEBHOOK_LOG_LEVEL": "INFO" if args.verbose else "WARNING",
+    })
+
+    import uvicorn
+    from fastapi import FastAPI
+    from app.database import mongodb
+    from app.tool import google_calendar
+    from app.tool.calendar_pool import CalendarServicePool
+    from app.agent import assistant
+    from app.agent.limiter import openai_admission
+    from app.webhook import dispatcher as dispatcher_module
+    from app.webhook.evolution_api import evolution_client
+    from app.webhook.router import router
+
+    if not args.mongo_uri:
+        import mongomock
+        mongo, mongo_lock = mongomock.MongoClient(os.environ["MONGO_URI"], tz_aware=True), threading.RLock()
+        mongodb.AsyncMongoClient = lambda *a, **kw: AsyncMongomock(
+            mongo, mongo_lock, args.mongo_latency, args.jitter, recorder)
+    mongodb.db_manager.ensure_indexes()
+
+    class BenchCalendarClient(google_calendar.GoogleCalendarClient):
+        def _authenticate(self):
+            self.pool = CalendarServicePool(
+                lambda: FakeCalendarService(args.calendar_latency, args.jitter, recorder)
+            )
+
+    google_calendar._client = BenchCalendarClient()
+
+    # Client-side timing of each stage
+    # Calls go through openai_admission, which uses the raw-response variant
+    completions = assistant.get_openai_client().chat.completions.with_raw_response
+    completions.create = recorder.timed("openai", completions.create)
+    evolution_client.send = recorder.timed("evolution_send", evolution_client.send)
+    turn_starts = {}
+    timed_turn = recorder.timed("agent_turn", dispatcher_module.process_message)
+
+    def process_message(user_id, user_message, *args):
+        with replies_lock:
+            turn_starts.setdefault(user_id.split("@")[0], []).append(time.perf_counter())
+        return timed_turn(user_id, user_message, *args)
+
+    dispatcher_module.process_message = process_message
+    dispatcher = dispatcher_module.dispatcher
+    original_record_wait = dispatcher._record_wait
+
+    def record_wait(wait):
+        recorder.add("queue_wait", wait)
+        original_record_wait(wait)
+
+    dispatcher._record_wait = record_wait
+
+    # Only the webhook router: the notification scheduler is not part of this path
+    app = FastAPI()
+    app.include_router(router)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=app_port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+
+    import requests
+
+    url = f"http://127.0.0.1:{app_port}/webhook"
+    posts = {}
+    posts_lock = threading.Lock()
+
+    def simulate_user(index: int):
+        number = f"55119{index:08d}"
+        session = requests.Session()
+        for i in range(args.messages):
+            payload = {
+                "event": "messages.upsert",
+                "instance": "bench",
+                "data": {
+                    "key": {"remoteJid": f"{number}@s.whatsapp.net", "fromMe": False, "id": uuid.uuid4().hex},
+                    "message": {"conversation": USER_TEXTS[i % len(USER_TEXTS)]},
+                    "pushName": f"Bench {index}",
+                    "messageTimestamp": int(time.time()),
+                },
+            }
+            sent = time.perf_counter()
+            with posts_lock:
+                posts.setdefault(number, []).append(sent)
+            session.post(url, json=payload, timeout=30)
+            recorder.add("webhook_ack", time.perf_counter() - sent)
+            time.sleep(random.uniform(0, 2 * args.think_time))
+
+    print(f"Driving {args.users} users x {args.messages} messages "
+          f"(openai {args.openai_latency}s, calendar {args.calendar_latency}s, "
+          f"evolution {args.evolution_latency}s, mongo {args.mongo_latency}s)...", file=sys.stderr)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(simulate_user, range(args.users)))
+
+    # Messages that arrive while a user's turn is running are answered together by the next turn,
+    # so the run is over when the dispatcher is idle and every started turn has replied
+    expected = args.users * args.messages
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        with replies_lock:
+            received = sum(len(times) for times in replies.values())
+            turns = sum(len(times) for times in turn_starts.values())
+        if not dispatcher._workers and received >= turns:
+            break
+        time.sleep(0.05)
+    finished = time.perf_counter()
+
+    # The n-th reply to a user comes from their n-th turn, which answers every message posted
+    # before it started; each message is measured from its own post
+    with replies_lock:
+        answered = 0
+        for number, reply_times in replies.items():
+            pending = list(posts.get(number, []))
+            for started_at, replied in zip(turn_starts.get(number, []), reply_times):
+                while pending and pending[0] <= started_at:
+                    recorder.add("end_to_end", replied - pending.pop(0))
+                    answered += 1
+        received = sum(len(times) for times in replies.values())
+
+    server.should_exit = True
+    elapsed = finished - started
+    return {
+        "config": vars(args),
+        "messages_sent": expected,
+        "replies_received": received,
+        "busy_replies": reply_texts[assistant.BUSY_MESSAGE],
+        "messages_answered": answered,
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(answered / elapsed, 2) if elapsed else 0.0,
+        "dispatcher": dispatcher.stats(),
+        "openai_admission": openai_admission.stats(),
+        "stages": recorder.summary(),
+    }
+
+
+def print_report(result: dict):
+    print()
+    print(f"messages: {result['messages_sent']}  answered: {result['messages_answered']}  "
+          f"replies: {result['replies_received']} ({result['busy_replies']} busy)  "
+          f"elapsed: {result['elapsed_seconds']}s  throughput: {result['messages_per_second']} msg/s")
+    print(f"{'stage':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    order = ["webhook_ack", "queue_wait", "agent_turn", "openai", "calendar_api", "mongo", "evolution_send", "end_to_end"]
+    stages = result["stages"]
+    for stage in order + sorted(set(stages) - set(order)):
+        if stage in stages:
+            s = stages[stage]
+            print(f"{stage:<16}{s['count']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="simulated WhatsApp users")
+    parser.add_argument("--messages", type=int, default=3, help="messages per user")
+    parser.add_argument("--think-time", type=float, default=0.5, help="mean pause between a user's messages (s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="DISPATCHER_MAX_CONCURRENCY")
+    parser.add_argument("--burst-window", type=float, default=0.0, help="BURST_WINDOW_SECONDS (0 = one turn per message)")
+    parser.add_argument("--openai-latency", type=float, default=0.4, help="stand-in chat completion latency (s)")
+    parser.add_argument("--openai-rpm", type=int, default=0, help="stand-in requests per minute before 429s (0 = unlimited)")
+    parser.add_argument("--calendar-latency", type=float, default=0.15, help="stand-in Calendar API latency (s)")
+    parser.add_argument("--evolution-latency", type=float, default=0.1, help="stand-in sendText latency (s)")
+    parser.add_argument("--evolution-rate", type=float, default=1000, help="EVOLUTION_RATE_LIMIT (msg/s)")
+    parser.add_argument("--mongo-latency", type=float, default=0.002, help="per-operation mongomock latency (s)")
+    parser.add_argument("--mongo-uri", help="use a real MongoDB instead of mongomock")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency standard deviation, as a fraction of the mean")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for outstanding replies")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--verbose", action="store_true", help="show the app's own log output")
+    parser.add_argument("--json", help="also write the full result as JSON to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # The app logs every webhook and tool call with print(); keep the report readable
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+        result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
+import asyncio
+import os
+import threading
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 from app.webhook.router import router
+from app.webhook.dispatcher import dispatcher
 from app.scheduler import start_scheduler
+from app.database.mongodb import async_db_manager, db_manager
+from app.followup.tasks import outbox_sender
+from app.telemetry import registry
+from app.agent.limiter import openai_admission
+from app.tool.google_calendar import get_calendar_client
+from app.agent.context import load_encoding
 
 load_dotenv()
 
@@ -14,9 +25,80 @@ app.include_router(router)
 async def root():
     return {"status": "online", "message": "Calendar Agent API is running (Modular)"}
 
+# Intervalo máximo entre as tentativas de preparar MongoDB e scheduler na inicialização
+STARTUP_RETRY_MAX_SECONDS = float(os.getenv("STARTUP_RETRY_MAX_SECONDS", "60"))
+
+# ready: índices criados e scheduler (timers, varredura, outbox) rodando; exposto em /health
+startup_state = {"ready": False, "error": None}
+_startup_stop = threading.Event()
+
+def prepare_storage_and_scheduler():
+    try:
+        # Autoriza o Google agora (link no terminal na primeira execução, refresh do token depois),
+        # e não dentro do primeiro turno de um usuário, que tem prazo
+        get_calendar_client()
+    except Exception as e:
+        print(f"Erro ao autenticar no Google Calendar: {e}")
+    # Vocabulário do tiktoken (pode ser baixado na primeira vez): carregado aqui, nunca num turno
+    load_encoding()
+
+    # Sem MongoDB não há timers, varredura nem outbox: tenta de novo até conseguir
+    delay = 1.0
+    while not _startup_stop.is_set():
+        try:
+            db_manager.ensure_indexes()
+            migrated = db_manager.migrate_legacy_history()
+            if migrated:
+                print(f"🗂️ Histórico de {migrated} usuários migrado para um documento por mensagem")
+            start_scheduler()
+            startup_state.update(ready=True, error=None)
+            return
+        except Exception as e:
+            startup_state["error"] = str(e)
+            print(f"Erro ao preparar o MongoDB e o scheduler, nova tentativa em {delay:.0f}s: {e}")
+            _startup_stop.wait(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_SECONDS)
+
+def _startup_finished(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        startup_state["error"] = repr(task.exception())
+        print(f"❌ Falha na inicialização: {task.exception()!r}")
+
+@app.get("/health")
+async def health():
+    if startup_state["ready"]:
+        return {"status": "ok"}
+    return JSONResponse({"status": "starting", "error": startup_state["error"]}, status_code=503)
+
+@app.get("/notifications/stats")
+async def notification_stats():
+    return outbox_sender.stats()
+
+registry.gauge("calendar_agent_dispatcher_queued_messages", "Messages waiting for an agent turn",
+               lambda: dispatcher.stats()["queued"])
+registry.gauge("calendar_agent_dispatcher_in_flight_turns", "Agent turns currently running",
+               lambda: dispatcher.stats()["in_flight"])
+registry.gauge("calendar_agent_openai_concurrency_limit", "Current adaptive limit of concurrent OpenAI calls",
+               lambda: openai_admission.limit)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Formato texto do Prometheus: histogramas de latência por etapa, tokens e iterações do agente
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.on_event("startup")
 async def startup_event():
-    start_scheduler()
+    # Índices, migração e timers dependem do MongoDB; rodam em segundo plano
+    # para que o servidor aceite requisições imediatamente
+    app.state.startup_task = asyncio.create_task(asyncio.to_thread(prepare_storage_and_scheduler))
+    app.state.startup_task.add_done_callback(_startup_finished)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    _startup_stop.set()
+    await dispatcher.shutdown()
+    outbox_sender.stop()
+    await async_db_manager.close()
 
 if __name__ == "__main__":
     import uvicorn
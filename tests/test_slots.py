@@ -0,0 +1,28 @@
+import datetime
+
+from app.tool.slots import TZ, find_free_slots
+
+UTC = datetime.timezone.utc
+HOUR = datetime.timedelta(hours=1)
+
+
+def test_slots_are_in_local_time_when_busy_events_use_another_offset():
+    # 12:00Z-13:00Z is 09:00-10:00 in Brasília
+    busy = [(datetime.datetime(2030, 1, 7, 12, tzinfo=UTC), datetime.datetime(2030, 1, 7, 13, tzinfo=UTC))]
+    range_start = TZ.localize(datetime.datetime(2030, 1, 7))
+    range_end = range_start + datetime.timedelta(days=1)
+
+    slots = find_free_slots(busy, range_start, range_end, HOUR, limit=3, max_per_day=3)
+
+    assert [start.strftime("%H:%M") for start, _ in slots] == ["08:00", "10:00", "11:00"]
+    assert all(start.utcoffset() == datetime.timedelta(hours=-3) for start, _ in slots)
+
+
+def test_range_given_in_utc_is_aligned_to_local_hours():
+    range_start = datetime.datetime(2030, 1, 7, 13, 10, tzinfo=UTC)  # 10:10 in Brasília
+    range_end = range_start + datetime.timedelta(hours=3)
+
+    slots = find_free_slots([], range_start, range_end, HOUR, limit=1)
+
+    assert slots[0][0] == TZ.localize(datetime.datetime(2030, 1, 7, 10, 30))
+    assert slots[0][0].strftime("%H:%M") == "10:30"
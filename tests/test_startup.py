@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_SECONDS = 1.0
+
+# Any connection attempt during import fails loudly; only the import itself is timed
+# (interpreter startup is not part of the app's budget)
+IMPORT_MAIN = """
+import socket, time
+
+def no_network(*args, **kwargs):
+    raise OSError("network access during import")
+
+socket.socket.connect = socket.socket.connect_ex = no_network
+socket.create_connection = no_network
+
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+"""
+
+
+def test_main_imports_quickly_without_network_or_credentials(tmp_path):
+    env = {"PATH": os.environ.get("PATH", ""), "HOME": str(tmp_path), "PYTHONPATH": ROOT,
+           "PYTHONDONTWRITEBYTECODE": "1"}
+    # Empty working directory: no token.json, credentials.json or .env
+    result = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    elapsed = float(result.stdout.strip().splitlines()[-1])
+    assert elapsed < IMPORT_BUDGET_SECONDS, f"importing main took {elapsed:.2f}s"
@@ -0,0 +1,46 @@
+import argparse
+import multiprocessing
+import os
+import signal
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def run_worker(threads: int):
+    # Importado dentro do processo filho: cada processo cria suas próprias conexões
+    from app.worker import AgentWorker
+    AgentWorker(threads=threads).run_forever()
+
+
+if __name__ == "__main__":
+    # Workers do agente para INGEST_MODE=queue: o main.py só grava as mensagens recebidas
+    # na fila e estes processos rodam os turnos (OpenAI, Calendar) e enfileiram as respostas
+    parser = argparse.ArgumentParser(description="Processa a fila de mensagens recebidas pelo webhook.")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("WORKER_PROCESSES", "2")))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WORKER_THREADS", "4")))
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker(args.threads)
+    else:
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=run_worker, args=(args.threads,), name=f"agent-worker-{i}")
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+
+        def forward_sigterm(signum, frame):
+            # docker stop/systemd só avisam o pai: repassa aos filhos, que terminam seus turnos
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, forward_sigterm)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # Ctrl+C chega a todos os processos do grupo; cada um termina seus turnos
+            for process in processes:
+                process.join()